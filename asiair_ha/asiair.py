@@ -1,20 +1,26 @@
 import asyncio
 from collections import namedtuple
-import struct
 import sys
-import tempfile
 import json, time
-import zipfile
 import paho.mqtt.client as mqtt
 import logging
-from hass_mqtt import binary_sensor, camera, climate, device_tracker, mqtt_device, sensor, switch
+from aiohttp import web
+from hass_mqtt import binary_sensor, button, camera, climate, device_tracker, mqtt_device, sensor, switch
 from astrolive.image import ImageManipulation
 from const import (
+    CALIBRATION_FRAME_TYPE_FIELD,
+    CAPTURE_COMPRESS_IMAGES,
     DEVICE_CLASS_SWITCH,
     DEVICE_TYPE_CAMERA_ICON,
     DEVICE_TYPE_FILTERWHEEL_ICON,
     DEVICE_TYPE_FOCUSER_ICON,
     DEVICE_TYPE_TELESCOPE_ICON,
+    EVENT_AGGREGATION,
+    IMAGE_FETCH_DEMAND,
+    IMAGE_FETCH_MODE,
+    LIVE_STACK_ENABLED,
+    POLL_ONCE,
+    TILE_PYRAMID_ENABLED,
     STATE_CLASS_MEASUREMENT,
     STATE_CLASS_NONE,
     UNIT_OF_MEASUREMENT_DEGREE,
@@ -25,6 +31,15 @@ from const import (
     UNIT_OF_MEASUREMENT_VOLTAGE,
 )
 import jsonrpc
+from calibration import FRAME_TYPE_DARK, FRAME_TYPE_FLAT, FRAME_TYPE_LIGHT, CalibrationKey, CalibrationLibrary, temperature_band
+from event_aggregator import EventAggregator
+from frame_history import FrameHistory
+from image_workers import run_image_job
+from image_channel import ImageChannel, ImageDemand
+from live_stack import LiveStack
+from protocol_capture import Capture, Replay
+import metrics
+from tile_pyramid import TilePyramid
 
 
 import cv2
@@ -136,15 +151,58 @@ def command_args(command):
         (method, args) = (command, [])
     return (method, args)
 
+RPC_LATENCY = metrics.histogram(
+    'astro_mqtt_asiair_rpc_seconds', 'Round trip of ASIAIR JSON-RPC calls, including time queued.',
+    ('connection', 'port', 'method'))
+EVENTS = metrics.counter(
+    'astro_mqtt_asiair_events_total', 'Events pushed by the ASIAIR.', ('connection', 'event'))
+IMAGE_STAGE = metrics.histogram(
+    'astro_mqtt_image_stage_seconds', 'Time spent in each stage of the image pipeline.', ('connection', 'stage'))
+
 class FromJson:
     def __init__(self, json_dict):
         self.__dict__ = json_dict
 
 class ZwoAsiair(ObservatorySoftware):
-
-    def __init__(self, name, address):
+    poll_interval = 45
+
+    def __init__(self, name, address=None, image_mode=IMAGE_FETCH_MODE, capture=None, replay=None, replay_realtime=True, capture_compress_images=CAPTURE_COMPRESS_IMAGES, frame_type_field=CALIBRATION_FRAME_TYPE_FIELD):
+        """ capture is a file to record the ASIAIR's traffic to; replay is
+        a capture to play back instead of connecting to an ASIAIR.
+        frame_type_field opts in to building calibration masters; see
+        CALIBRATION_FRAME_TYPE_FIELD.
+        """
         self._address = address
+        self.capture_path = capture
+        self.capture_compress_images = capture_compress_images
+        self.capture = None
+        if replay is not None:
+            self.open_connection = Replay(replay, realtime=replay_realtime).open_connection
+        else:
+            self.open_connection = asyncio.open_connection
+        self.image_mode = image_mode
+        self.frame_history = FrameHistory()
+        self.live_stack = LiveStack()
+        self.live_stack_enabled = LIVE_STACK_ENABLED
+        self.calibration = CalibrationLibrary()
+        self.frame_type_field = frame_type_field
+        self.tile_pyramid = TilePyramid() if TILE_PYRAMID_ENABLED else None
+        self.camera_name = None
+        self.exposure_event = None
+        # The last value read of each camera control, refreshed by polls and on
+        # CameraControlChange, and the gain and exposure of the current frame.
+        self.control_values = {}
+        self.exposure_settings = (None, None)
+        self.frame_settings = (None, None)
+        self.event_aggregator = EventAggregator(EVENT_AGGREGATION, self._handle_event)
+        # Created up front so the HTTP routes work before the ASIAIR is reachable.
+        self.image_demand = ImageDemand()
+        self.port4400 = None
+        self.port4700 = None
+        self.images = None
         self.rpc_command_id = 1
+        # Futures for the calls awaiting a response on each port, by request id.
+        self.rpc_pending = {4400: {}, 4700: {}}
 
         # Cache some information - factor this out to device later.
         self.wheel_names = None
@@ -159,21 +217,46 @@ class ZwoAsiair(ObservatorySoftware):
         super().__init__(name)
 
     @staticmethod
-    def create(name: str, address: str, **kwargs):
-        return ZwoAsiair(name, address=address)
+    def create(name: str, address: str = None, **kwargs):
+        return ZwoAsiair(name, address=address, **kwargs)
      
     async def connect(self):
+        if self.capture_path is not None and self.capture is None:
+            # Opened on first use, so that just creating the connection doesn't truncate an earlier capture.
+            self.capture = Capture(self.capture_path, compress_images=self.capture_compress_images)
+            self.open_connection = self.capture.open_connection
+        # Open both RPC ports here so that an offline ASIAIR fails the connect.
+        print("Connecting to port 4400")
+        (reader4400, writer4400) = await self.open_connection(self._address, 4400)
+        try:
+            print("Connecting to port 4700")
+            (reader4700, writer4700) = await self.open_connection(self._address, 4700)
+        except:
+            writer4400.close()
+            raise
+
+        # Drop anything left from an earlier attempt.
+        for task in (self.port4400, self.port4700, self.images):
+            if task is not None:
+                task.cancel()
+
         self.update_q = asyncio.Queue()
         self.cmd_q_4400 = asyncio.Queue()
         self.cmd_q_4700 = asyncio.Queue()
         self.event_q = asyncio.Queue()
+        self.rpc_pending = {4400: {}, 4700: {}}
         self.image_available = asyncio.Event()
-        self.port4400 = asyncio.create_task(self.read_events(self.cmd_q_4400, 4400))
-        self.port4700 = asyncio.create_task(self.read_events(self.cmd_q_4700, 4700))
+        if getattr(self, 'image_channel', None) is None:
+            # Kept across reconnects, so that its reconnect count keeps counting.
+            self.image_channel = ImageChannel(self._address, 4800, open_connection=self.open_connection)
+        self.port4400 = asyncio.create_task(self.read_events(self.cmd_q_4400, 4400, reader4400, writer4400))
+        self.port4700 = asyncio.create_task(self.read_events(self.cmd_q_4700, 4700, reader4700, writer4700))
         self.images = asyncio.create_task(self.read_images())
 
     async def get_control_value(self, value_name: str):
-        return (await self.jsonrpc_call(4700, 'get_control_value', value_name))['value']
+        value = (await self.jsonrpc_call(4700, 'get_control_value', value_name))['value']
+        self.control_values[value_name] = value
+        return value
 
     async def set_control_value(self, value_name: str, value):
         error_code = await self.jsonrpc_call(4700, 'set_control_value', value_name, value)
@@ -240,58 +323,76 @@ class ZwoAsiair(ObservatorySoftware):
             cmd_q = self.cmd_q_4700
         else:
             return NotImplementedError
-        event = asyncio.Event()
-        await cmd_q.put((command, args, event))
-        # would be better as a single-item queue
-        await event.wait()
-        if event.result is not None:
-            return event.result
+        reader = self.port4400 if port == 4400 else self.port4700
+        if reader is None or reader.done():
+            raise ConnectionError('Not connected to port {0}'.format(port))
+        pending = self.rpc_pending[port]
+        id = self._next_rpc_id()
+        future = pending[id] = asyncio.get_running_loop().create_future()
+        try:
+            with RPC_LATENCY.time(connection=self.name, port=port, method=command):
+                await cmd_q.put((command, args, id))
+                message = await future
+        finally:
+            # Also when the caller gives up, so abandoned calls don't accumulate.
+            pending.pop(id, None)
+        if message.get('result') is not None:
+            return message['result']
         else:
-            logging.error('Error during synchronous call: %s', event.error)
+            logging.error('Error during synchronous call: %s', message.get('error', None))
             sys.exit(0)
 
+    def _next_rpc_id(self):
+        id = self.rpc_command_id
+        self.rpc_command_id += 1
+        return id
+
     async def discover(self):
         self.pi_info = FromJson(await self.jsonrpc_call(4700, 'pi_get_info'))
         logging.debug(self.pi_info)
         return self.devices
   
     async def poll(self):
+        """ Handle events until the connection to either RPC port is lost. """
+        # Process events from the event queue.
+        async def event_loop():
+            while True:
+                try:
+                    (event, payload) = await self.event_q.get()
+                    await self.event_aggregator.put(event, payload)
+                except Exception as ex:
+                    logging.error(ex)
+                    sys.exit(0)
+
+        events = None
         try:
-            logging.debug(">>>>>>>>>>>>>>>>>>> Getting filter wheel")
-            (self.wheel_names, position) = await asyncio.gather(
-                self.jsonrpc_call(4700, 'get_wheel_slot_name'),
-                self.jsonrpc_call(4700, 'get_wheel_position')
-            )
-            if len(self.wheel_names) > 0:
-                await self.update_q.put({'method': 'WheelName', 'code': 0, 'result': self.wheel_names[position]}),
-
-            # Process events from the event queue.
-            async def event_loop():
-                while True:
-                    try:
-                        (event, payload) = await self.event_q.get()
-                        await self._handle_event(event, payload)
-                    except Exception as ex:
-                        logging.error(ex)
-                        sys.exit(0)
-
-            async def poll_loop():
-                while True:
-                    # Publish all components.
-                    try:
-                        for device in self.devices.values():
-                            for component in device.components():
-                                logging.debug(component)
-                                await component.publish(device)
-                        await asyncio.sleep(45)
-                    except Exception as ex:
-                        logging.error(ex)
-                        sys.exit(0)
+            try:
+                logging.debug(">>>>>>>>>>>>>>>>>>> Getting filter wheel")
+                (self.wheel_names, position) = await asyncio.gather(
+                    self.jsonrpc_call(4700, 'get_wheel_slot_name'),
+                    self.jsonrpc_call(4700, 'get_wheel_position')
+                )
+                if len(self.wheel_names) > 0:
+                    await self.update_q.put({'method': 'WheelName', 'code': 0, 'result': self.wheel_names[position]}),
+            except Exception as ex:
+                logging.error("Poll error %s", ex)
+
             logging.debug(">>>>>>>>>>>>>>>>>>> Polling")
-            asyncio.gather(poll_loop(), event_loop(), self.port4400, self.port4700, self.images)
-        except Exception as ex:
-            logging.error("Poll error %s", ex)
-            sys.exit(0)
+            events = asyncio.create_task(event_loop())
+            await asyncio.wait([self.port4400, self.port4700], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # Closing both ports fails any calls still waiting on them.
+            tasks = [task for task in (events, self.port4400, self.port4700, self.images) if task is not None]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.image_channel.close()
+
+    async def close(self):
+        await self.event_aggregator.close()
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
 
     async def _handle_event(self, event, payload: dict|bytearray):
         logging.debug('Event %s %s', event, payload)
@@ -300,19 +401,30 @@ class ZwoAsiair(ObservatorySoftware):
         asiair = self.devices['asiair']
         telescope = self.devices['telescope']
         if event == "Exposure":
-            if payload["state"] == "complete":
+            if payload["state"] == "start":
+                self.exposure_settings = (self.control_values.get('Gain'), self.control_values.get('Exposure'))
+            elif payload["state"] == "complete":
+                self.exposure_event = payload
+                self.frame_settings = self.exposure_settings
+                self.exposure_settings = (None, None)
                 self.image_available.set()
             await camera.state.publish(camera)
         elif event == "Temperature":
             camera.sensor_temperature = payload['value']
-            await camera.cooling.publish(camera)
+            # The setpoint and mode haven't changed; don't ask for them again.
+            await camera.cooling.publish(camera, topics=['current_temperature'])
         elif event == "CoolerPower":
             await camera.cooler_power.publish(camera)
         elif event == 'ImageDownload':
             camera.latest_image = payload
             await camera.image.publish(camera)
+            await camera.timelapse.publish(camera)
             # We don't need to keep sending this on poll.
             camera.latest_image = None
+        elif event == 'StackUpdated':
+            camera.latest_stack = payload
+            await camera.stacked_image.publish(camera)
+            camera.latest_stack = None
         elif event == "PiStatus":
             asiair.pi_status = FromJson(payload)
             await asiair.cpu_temp.publish(asiair)
@@ -320,6 +432,8 @@ class ZwoAsiair(ObservatorySoftware):
             await telescope.tracking.publish(telescope)
 
         if event == "WheelMove" and payload["state"] == "complete":
+            # Frames through a different filter don't belong in the same stack.
+            self.live_stack.reset()
             await efw.current.publish(efw)
         elif event == "CameraControlChange":
             for component in [camera.gain, camera.exposure_seconds, camera.cooler_power, camera.dewheater, camera.cooling]:
@@ -331,116 +445,229 @@ class ZwoAsiair(ObservatorySoftware):
             await self.update_q.put({'method': 'scope_get_track_state', 'code': 0, 'result': payload["state"] == "on"})
 
 
-    async def read_events(self, cmd_q, port: int):
+    async def read_events(self, cmd_q, port: int, reader, writer):
         q = self.update_q
-        event_map = {}
-        print("Connecting to port " + str(port))
-        reader, writer = await asyncio.open_connection('asiair', port)
+        pending = self.rpc_pending[port]
 
         async def exec_and_keepalive(interval_seconds: int = 8):
-            id = 1
             while True:
                 try:
                     command = await asyncio.wait_for(cmd_q.get(), interval_seconds)
                     if isinstance(command, tuple) and len(command) == 3:
-                        (method, args, event) = command
+                        (method, args, id) = command
                         command = (method, args)
-                        event_map[id] = event
+                    else:
+                        id = self._next_rpc_id()
                     writer.write((json.dumps(jsonrpc.make_command(id, command)) + "\r\n").encode())
-                    id += 1
                 except asyncio.TimeoutError:
                     await self.jsonrpc_call_async(port, "test_connection")
                 except Exception as ex:
                     logging.error("Failed in command handling: %s", ex)
 
         keepalive = asyncio.create_task(exec_and_keepalive())
-        while True:
-            message = await reader.readline()
-            if not message:
-                print("EOF on port " + str(port))
-                break
-            #print("Putting on Q: " + message.decode())
-            message = message.replace(b"<\x90\xadE\xb6>", b"???")
-            message = message.replace(b"<\xe8>", b"???")
-            message = message.decode('iso-8859-1')
-            try:
-                message = json.loads(message)
-                if "method" in message and message["id"] in event_map:
+        try:
+            while True:
+                message = await reader.readline()
+                if not message:
+                    logging.warning('EOF on port %d', port)
+                    break
+                #print("Putting on Q: " + message.decode())
+                message = message.replace(b"<\x90\xadE\xb6>", b"???")
+                message = message.replace(b"<\xe8>", b"???")
+                message = message.decode('iso-8859-1')
+                try:
+                    message = json.loads(message)
+                    if "method" in message and message.get("id") in pending:
 #                    logging.debug("Reponse to message %d", message["id"])
-                    event = event_map[message["id"]]
-                    try:
-                        event.result = message["result"]
-                    except KeyError as ke:
-                        event.result = None
-                        event.error = message.get("error", None)
-                    event.set()
-
-                # Handle any immediate routing/updates.
-                #logging.debug("Received %s", message)
-                if "Event" in message:
-                    try:
-                        #await self._handle_event(message["Event"], message)
-                        await self.event_q.put((message['Event'], message))
-                    except Exception as ex:
-                        logging.debug(ex)
-                        sys.exit(1)
-                # Send it to the legacy queue.
-                await q.put(message)
-            except Exception as ex:
-                logging.error(ex)
-        await keepalive
-
-    async def read_images(self, port=4800):
+                        future = pending.pop(message["id"])
+                        if not future.done():
+                            future.set_result(message)
+
+                    # Handle any immediate routing/updates.
+                    #logging.debug("Received %s", message)
+                    if "Event" in message:
+                        EVENTS.inc(connection=self.name, event=message['Event'])
+                        try:
+                            #await self._handle_event(message["Event"], message)
+                            await self.event_q.put((message['Event'], message))
+                        except Exception as ex:
+                            logging.debug(ex)
+                            sys.exit(1)
+                    # Send it to the legacy queue.
+                    await q.put(message)
+                except Exception as ex:
+                    logging.error(ex)
+        finally:
+            keepalive.cancel()
+            writer.close()
+            # Nothing more will be answered on this connection.
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Connection to port {0} closed'.format(port)))
+            pending.clear()
+
+    async def read_images(self):
         image_available = self.image_available
-        id = 1
         while True:
             try:
                 await image_available.wait()
+                if self.image_mode == IMAGE_FETCH_DEMAND and not self.image_demand.is_wanted():
+                    # Leave the image pending until someone asks for it.
+                    logging.debug('Image available but not wanted, skipping download')
+                    await self.image_demand.wait_until_wanted()
+                    continue
                 image_available.clear()
-                reader, writer = await asyncio.open_connection('asiair', port)
-                command = "get_current_img"
-                writer.write((json.dumps({"id": id, "method": command}) + "\r\n").encode())
-                await writer.drain()
-                id = id + 1
-                print(str(port) + " Reading 80")
-                header = await reader.readexactly(80) # Header, discard for now
-                # Byte 6-9 - size
-                # Byte 16,17 - width
-                # Byte 18,19 - height
-                if len(header) < 80:
-                    print(str(port) + " Failed to read header")
-                else:
-                    (size, width, height) = struct.unpack("!xxxxxxIxxxxxxHHxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx", header)
-                    remaining = size
-                    print(str(port) + " Header " + str((size, width, height)))
-                    if width > 0:
-                        logging.debug(str(port) + " Zipped Image Size: " + str(size) + " " + str(width) + "x" + str(height))
-                        with tempfile.TemporaryFile("w+b") as f:
-                            while remaining > 0:
-                                chunkSize = min(remaining, 4*1024*1024)
-                                chunk = await reader.read(chunkSize)
-                                f.write(chunk)
-                                remaining = remaining - len(chunk)
-                                print(str(port) + " Downloading... " + str(remaining))
-                            f.seek(0)
-                            z = zipfile.ZipFile(f)
-                            with z.open("raw_data", mode="r") as rawData:
-                                rawImage = np.ndarray(shape=(height, width), dtype="<u2", buffer=rawData.read())
-                                imageData = await ImageManipulation.normalize_image(rawImage)
-                                imageData = await ImageManipulation.compute_astropy_stretch(imageData)
-                                imageData = await ImageManipulation.resize_image(imageData)
-                                (result, imageData) = cv2.imencode(".png", imageData)
-                                byteArray = bytearray(imageData)
-                                print("MQTT publish result: " + str(result) + "; Len: " + str(len(byteArray)))
-
-                                # New path
-                                await self.event_q.put(('ImageDownload', byteArray))
-                    else:
-                        print(str(port) + " Width <= 0")
-                        print(str(port) + " => " + str(header))
+                with IMAGE_STAGE.time(connection=self.name, stage='fetch'):
+                    rawImage = await self.image_channel.fetch()
+                if rawImage is None:
+                    continue
+                if self.tile_pyramid is not None:
+                    self.tile_pyramid.set_frame(rawImage)
+                factor = ImageManipulation.bin_factor(rawImage)
+                frame_type = self._frame_type()
+                key = await self._calibration_key(rawImage.shape, factor)
+                (preview, pngData, stackData) = await run_image_job(
+                    self._process_frame, rawImage, factor, frame_type, key)
+
+                byteArray = bytearray(pngData)
+                logging.debug("PNG encode length: %d", len(byteArray))
+                self.frame_history.add(preview, byteArray)
+                await self.event_q.put(('ImageDownload', byteArray))
+                if stackData is not None:
+                    await self.event_q.put(('StackUpdated', bytearray(stackData)))
             except Exception as ex:
                 logging.error(ex)
 
+    def _frame_type(self):
+        """ Dark or flat if frame_type_field of the Exposure event says so, otherwise light. """
+        if self.frame_type_field is None:
+            return FRAME_TYPE_LIGHT
+        frame_type = str((self.exposure_event or {}).get(self.frame_type_field, '')).lower()
+        return frame_type if frame_type in (FRAME_TYPE_DARK, FRAME_TYPE_FLAT) else FRAME_TYPE_LIGHT
+
+    async def _calibration_key(self, shape, factor):
+        """ The calibration masters that match the frame just taken, or None if
+        its gain and exposure weren't known when it started. """
+        camera = self.devices['camera']
+        (gain, exposure) = self.frame_settings
+        if gain is None or exposure is None:
+            logging.debug('Settings of the frame are unknown, leaving it uncalibrated')
+            return None
+        if self.camera_name is None:
+            try:
+                self.camera_name = await camera._device_name()
+            except Exception as ex:
+                logging.warning('Reading the camera name failed, leaving the frame uncalibrated: %s', ex)
+                return None
+        (height, width) = shape
+        return CalibrationKey(
+            camera=self.camera_name,
+            gain=gain,
+            exposure=exposure,
+            binning='{0}x{1}_bin{2}'.format(width, height, factor),
+            temperature_band=temperature_band(camera.sensor_temperature))
+
+    def _process_frame(self, rawImage, factor, frame_type, key):
+        """ Bin, calibrate, stretch and encode a frame, and add lights to the live stack.
+
+        Runs on the shared image pool; returns (preview, PNG, stack PNG or None).
+        """
+        def stage(name):
+            return IMAGE_STAGE.time(connection=self.name, stage=name)
+
+        with stage('bin'):
+            imageData = ImageManipulation.bin_image(rawImage, factor)
+        with stage('calibrate'):
+            if key is None:
+                # The frame's settings are unknown; publish it uncalibrated.
+                pass
+            elif frame_type == FRAME_TYPE_LIGHT:
+                self.calibration.apply(key, imageData)
+            else:
+                # Build masters from calibration frames.
+                self.calibration.add(frame_type, key, imageData)
+            imageData = ImageManipulation.normalize_image(imageData)
+
+        with stage('stretch'):
+            preview = self._render_preview(imageData)
+        with stage('encode'):
+            (_, pngData) = cv2.imencode(".png", preview)
+
+        stackData = None
+        with stage('stack'):
+            if frame_type == FRAME_TYPE_LIGHT and self.live_stack_enabled and self.live_stack.add(imageData):
+                # The stack may be reset from the event loop meanwhile.
+                accumulator = self.live_stack.accumulator
+                if accumulator is not None:
+                    stack = self._render_preview(accumulator)
+                    (_, stackData) = cv2.imencode(".png", stack)
+        return (preview, pngData, stackData)
+
+    def _render_preview(self, imageData):
+        imageData = ImageManipulation.compute_astropy_stretch(imageData)
+        return ImageManipulation.resize_image(imageData)
+
+    def http_routes(self):
+        routes = [
+            ('GET', '/camera/image.png', self._http_image),
+            ('GET', '/camera/timelapse.webp', self._http_timelapse),
+            ('GET', '/camera/gallery', self._http_gallery),
+            ('GET', '/camera/gallery/{id}.png', self._http_gallery_image),
+        ]
+        if self.tile_pyramid is not None:
+            routes += [
+                ('GET', '/camera/tiles/latest.dzi', self._http_latest_tiles),
+                ('GET', r'/camera/tiles/{frame:\d+}.dzi', self._http_tiles_descriptor),
+                ('GET', r'/camera/tiles/{frame:\d+}_files/{level:\d+}/{col:\d+}_{row:\d+}.jpg', self._http_tile),
+            ]
+        return routes
+
+    async def _http_image(self, request):
+        self.image_demand.touch('HTTP')
+        frame = self.frame_history.latest()
+        if frame is None:
+            raise web.HTTPNotFound(text='No image yet')
+        return web.Response(body=frame.png, content_type='image/png')
+
+    async def _http_timelapse(self, request):
+        timelapse = self.frame_history.timelapse()
+        if timelapse is None:
+            raise web.HTTPNotFound(text='No images yet')
+        return web.Response(body=timelapse, content_type='image/webp')
+
+    async def _http_gallery(self, request):
+        return web.json_response(self.frame_history.gallery())
+
+    def _tile_frame(self, request):
+        pyramid = self.tile_pyramid
+        if pyramid.frame is None:
+            raise web.HTTPNotFound(text='No image yet')
+        if int(request.match_info['frame']) != pyramid.frame_id:
+            raise web.HTTPGone(text='Frame has been replaced')
+        return pyramid
+
+    async def _http_latest_tiles(self, request):
+        if self.tile_pyramid.frame is None:
+            raise web.HTTPNotFound(text='No image yet')
+        raise web.HTTPFound('{0}.dzi'.format(self.tile_pyramid.frame_id))
+
+    async def _http_tiles_descriptor(self, request):
+        pyramid = self._tile_frame(request)
+        return web.Response(text=pyramid.descriptor(), content_type='application/xml')
+
+    async def _http_tile(self, request):
+        pyramid = self._tile_frame(request)
+        (level, col, row) = (int(request.match_info[k]) for k in ('level', 'col', 'row'))
+        if not pyramid.has_tile(level, col, row):
+            raise web.HTTPNotFound(text='No such tile')
+        return web.Response(body=await pyramid.tile(level, col, row), content_type='image/jpeg')
+
+    async def _http_gallery_image(self, request):
+        frame = self.frame_history.get(int(request.match_info['id']))
+        if frame is None:
+            raise web.HTTPNotFound(text='Image no longer in history')
+        return web.Response(body=frame.png, content_type='image/png')
+
 class ZwoAsiairDevice(Device):
     def __init__(self, parent: ZwoAsiair, name):
         super().__init__(parent, name)
@@ -488,6 +715,7 @@ class ZwoAsiairPi(ZwoAsiairDevice):
     @sensor(
         name='Wifi Station Signal Strength',
         unit_of_measurement='dB',
+        deadband=3,
         icon='mdi:wifi',
         device_class='signal_strength',
         state_class='measurement',
@@ -508,6 +736,8 @@ class ZwoAsiairPi(ZwoAsiairDevice):
     
     @sensor(
         name='Wifi Station SSID',
+        poll_interval=3600,
+        retain=True,
         icon='mdi:wifi',
         entity_category='diagnostic',
     ) 
@@ -516,6 +746,8 @@ class ZwoAsiairPi(ZwoAsiairDevice):
 
     @sensor(
         name='Wifi Station IP',
+        poll_interval=3600,
+        retain=True,
         icon='mdi:wifi',
         entity_category='diagnostic',
     ) 
@@ -524,6 +756,8 @@ class ZwoAsiairPi(ZwoAsiairDevice):
     
     @sensor(
         name='Wifi Station Gateway',
+        poll_interval=3600,
+        retain=True,
         icon='mdi:wifi',
         entity_category='diagnostic',
     ) 
@@ -532,6 +766,8 @@ class ZwoAsiairPi(ZwoAsiairDevice):
     
     @sensor(
         name='Wifi Station Netmask',
+        poll_interval=3600,
+        retain=True,
         icon='mdi:wifi',
         entity_category='diagnostic',
     ) 
@@ -540,6 +776,8 @@ class ZwoAsiairPi(ZwoAsiairDevice):
 
     @sensor(
         name='CPU ID',
+        poll_interval=POLL_ONCE,
+        retain=True,
         unit_of_measurement=UNIT_OF_MEASUREMENT_NONE,
         icon='mdi:raspberry-pi',
         entity_category='diagnostic',
@@ -550,6 +788,7 @@ class ZwoAsiairPi(ZwoAsiairDevice):
     @sensor(
         name='CPU Temperature',
         unit_of_measurement=UNIT_OF_MEASUREMENT_TEMP_CELSIUS,
+        deadband=0.5,
         icon='mdi:thermometer',
         entity_category='diagnostic',
     ) 
@@ -564,6 +803,7 @@ class ZwoAsiairPi(ZwoAsiairDevice):
     @sensor(
         name='Port 1 Voltage',
         unit_of_measurement='V',
+        deadband=0.05,
         icon='mdi:flash',
         device_class='voltage',
         state_class='measurement',
@@ -576,6 +816,7 @@ class ZwoAsiairPi(ZwoAsiairDevice):
     @sensor(
         name='Port 2 Voltage',
         unit_of_measurement='V',
+        deadband=0.05,
         icon='mdi:flash',
         device_class='voltage',
         state_class='measurement',
@@ -588,6 +829,7 @@ class ZwoAsiairPi(ZwoAsiairDevice):
     @sensor(
         name='Port 3 Voltage',
         unit_of_measurement='V',
+        deadband=0.05,
         icon='mdi:flash',
         device_class='voltage',
         state_class='measurement',
@@ -600,6 +842,7 @@ class ZwoAsiairPi(ZwoAsiairDevice):
     @sensor(
         name='Port 4 Voltage',
         unit_of_measurement='V',
+        deadband=0.05,
         icon='mdi:flash',
         device_class='voltage',
         state_class='measurement',
@@ -612,6 +855,7 @@ class ZwoAsiairPi(ZwoAsiairDevice):
     @sensor(
         name='Input Voltage',
         unit_of_measurement='V',
+        deadband=0.05,
         icon='mdi:flash',
         device_class='voltage',
         state_class='measurement',
@@ -624,6 +868,7 @@ class ZwoAsiairPi(ZwoAsiairDevice):
     @sensor(
         name='Input Voltage',
         unit_of_measurement='V',
+        deadband=0.05,
         icon='mdi:flash',
         device_class='voltage',
         state_class='measurement',
@@ -636,6 +881,7 @@ class ZwoAsiairPi(ZwoAsiairDevice):
     @sensor(
         name='Input Current',
         unit_of_measurement='A',
+        deadband=0.02,
         icon='mdi:flash',
         device_class='current',
         state_class='measurement',
@@ -648,6 +894,7 @@ class ZwoAsiairPi(ZwoAsiairDevice):
     @sensor(
         name='Input Power',
         unit_of_measurement='W',
+        deadband=0.2,
         icon='mdi:flash',
         device_class='power',
         state_class='measurement',
@@ -674,6 +921,7 @@ class Telescope(ZwoAsiairDevice):
     @sensor(
         name="Altitude",
         unit_of_measurement=UNIT_OF_MEASUREMENT_DEGREE,
+        deadband=0.01,
         icon=DEVICE_TYPE_TELESCOPE_ICON,
         state_class=STATE_CLASS_MEASUREMENT,
     ) 
@@ -683,6 +931,7 @@ class Telescope(ZwoAsiairDevice):
     @sensor(
         name="Azimuth",
         unit_of_measurement=UNIT_OF_MEASUREMENT_DEGREE,
+        deadband=0.01,
         icon=DEVICE_TYPE_TELESCOPE_ICON,
         state_class=STATE_CLASS_MEASUREMENT,
     ) 
@@ -692,6 +941,7 @@ class Telescope(ZwoAsiairDevice):
     @sensor(
         name="Right Ascension",
         unit_of_measurement=UNIT_OF_MEASUREMENT_DEGREE,
+        deadband=0.01,
         icon=DEVICE_TYPE_TELESCOPE_ICON,
         state_class=STATE_CLASS_MEASUREMENT,
     ) 
@@ -701,6 +951,7 @@ class Telescope(ZwoAsiairDevice):
     @sensor(
         name="Declination",
         unit_of_measurement=UNIT_OF_MEASUREMENT_DEGREE,
+        deadband=0.01,
         icon=DEVICE_TYPE_TELESCOPE_ICON,
         state_class=STATE_CLASS_MEASUREMENT,
     ) 
@@ -743,6 +994,7 @@ class Telescope(ZwoAsiairDevice):
 
     @device_tracker(
         name='Site Location',
+        poll_interval=3600,
         icon=DEVICE_TYPE_TELESCOPE_ICON,
         subscription_topics=['json_attributes'],
     )
@@ -755,6 +1007,7 @@ class Telescope(ZwoAsiairDevice):
     
     @binary_sensor(
         name='Slewing',
+        poll_interval=5,
         icon='mdi:rotate-orbit',
     )
     async def is_slewing(self):
@@ -823,6 +1076,7 @@ class AsiAirCamera(ZwoAsiairDevice, Camera):
     def __init__(self, parent: ZwoAsiair, name):
         self.sensor_temperature = None
         self.latest_image = None
+        self.latest_stack = None
         super().__init__(parent, name)
 
     def get_mqtt_device_config(self):
@@ -843,6 +1097,74 @@ class AsiAirCamera(ZwoAsiairDevice, Camera):
     async def image(self):
         return self.latest_image
 
+    @camera(
+        name="Time-lapse",
+        unit_of_measurement=UNIT_OF_MEASUREMENT_NONE,
+        icon='mdi:filmstrip',
+    )
+    async def timelapse(self):
+        # Only sent alongside a new image, not on every poll.
+        if self.latest_image is None:
+            return None
+        return self.parent.frame_history.timelapse()
+
+    @timelapse.json_attributes
+    async def gallery(self):
+        return {
+            'frames': self.parent.frame_history.gallery(),
+        }
+
+    @camera(
+        name="Live Stack",
+        unit_of_measurement=UNIT_OF_MEASUREMENT_NONE,
+        icon='mdi:layers-triple',
+    )
+    async def stacked_image(self):
+        return self.latest_stack
+
+    @stacked_image.json_attributes
+    async def stacked_image_attributes(self):
+        return {
+            'Frames': self.parent.live_stack.count,
+            'Rejected': self.parent.live_stack.rejected,
+        }
+
+    @switch(
+        name='Live Stacking',
+        icon='mdi:layers-triple',
+    )
+    async def live_stacking(self):
+        return self.parent.live_stack_enabled
+
+    @live_stacking.command
+    async def set_live_stacking(self, on: bool):
+        self.parent.live_stack_enabled = bool(on)
+        if not on:
+            self.parent.live_stack.reset()
+        return bool(on)
+
+    @button(
+        name="Reset Live Stack",
+        icon='mdi:layers-remove',
+    )
+    async def reset_live_stack(self):
+        return None
+
+    @reset_live_stack.command
+    async def press_reset_live_stack(self, payload):
+        self.parent.live_stack.reset()
+
+    @button(
+        name="Request Image",
+        icon=DEVICE_TYPE_CAMERA_ICON,
+    )
+    async def image_wanted(self):
+        return None
+
+    @image_wanted.command
+    async def request_image(self, payload):
+        self.parent.image_demand.touch('MQTT')
+
     async def _device_name(self):
         return (await self.parent.jsonrpc_call(4700, 'get_camera_state'))['name']
 
@@ -894,6 +1216,7 @@ class AsiAirCamera(ZwoAsiairDevice, Camera):
     @climate(
         name='Cooling',
         temperature_unit='C',
+        deadband=0.1,
         icon='mdi:snowflake',
         max_temp=40,
         min_temp=-40,
@@ -0,0 +1,375 @@
+""" A stand-in ASIAIR for development and load testing.
+
+Serves the JSON-RPC ports 4400 and 4700, answering the methods the bridge
+uses from a small simulated rig, and pushes Temperature, CoolerPower,
+GuideStep and PiStatus events at configurable rates, plus Exposure events
+for an endless sequence of exposures. Port 4800 serves each exposure as a
+zipped synthetic star field.
+
+Responses can be delayed (latency plus uniform jitter), and faults injected:
+requests left unanswered, answered with an error, garbage lines, dropped
+connections and truncated images.
+
+Usage: python asiair_simulator.py [--host 127.0.0.1] [--rate Temperature=50] [--latency 0.05] ...
+Then point an asiair connection's address at the host. Several simulators
+can run at once on different loopback addresses (127.0.0.2, ...).
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import logging
+import random
+import time
+import zipfile
+
+import numpy as np
+
+from image_channel import IMAGE_HEADER
+
+EVENT_RATES = {
+    'Temperature': 1,
+    'CoolerPower': 0.5,
+    'GuideStep': 0.5,
+    'PiStatus': 0.2,
+}
+EXPOSURE_SECONDS = 10
+FRAME_DIMENSIONS = (1920, 1280)
+FRAME_COUNT = 3
+FRAME_STARS = 300
+STATS_INTERVAL_SECONDS = 10
+
+
+def synthetic_frame(width: int, height: int, seed: int, drift=0):
+    """ Sky background and gaussian stars, shifted drift pixels to the right. """
+    rng = np.random.default_rng(0)
+    frame = np.random.default_rng(seed).normal(1000, 30, (height, width))
+    ys = rng.integers(4, height - 4, FRAME_STARS)
+    xs = (rng.integers(4, width - 4, FRAME_STARS) + drift) % (width - 8) + 4
+    fluxes = rng.uniform(2e3, 4e4, FRAME_STARS)
+    (yy, xx) = np.mgrid[-3:4, -3:4]
+    psf = np.exp(-(xx**2 + yy**2) / (2 * 1.5**2))
+    for (y, x, flux) in zip(ys, xs, fluxes):
+        frame[y - 3:y + 4, x - 3:x + 4] += flux * psf
+    return np.clip(frame, 0, 65535).astype('<u2')
+
+
+def zipped_frame(frame):
+    """ A frame as the ASIAIR sends it: a zip holding raw_data. """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('raw_data', frame.tobytes())
+    (height, width) = frame.shape
+    data = buffer.getvalue()
+    return IMAGE_HEADER.pack(len(data), width, height) + data
+
+
+class SimulatedRig:
+    """ The state the RPC methods read and change. """
+    def __init__(self):
+        self.controls = {
+            'Gain': 100,
+            'Exposure': EXPOSURE_SECONDS * 1000 * 1000,
+            'CoolerOn': 1,
+            'TargetTemp': -10,
+            'CoolPowerPerc': 40,
+            'AntiDewHeater': 0,
+            'Temperature': 5,
+        }
+        self.tracking = True
+        self.wheel_position = 0
+        self.focuser_position = 12000
+        self.camera_state = 'idle'
+        self.ra = 83.8
+        self.dec = -5.4
+
+    def step(self):
+        """ Move the sensor temperature towards the setpoint. """
+        target = self.controls['TargetTemp'] if self.controls['CoolerOn'] else 15
+        temperature = self.controls['Temperature']
+        self.controls['Temperature'] = round(temperature + (target - temperature) * 0.05 + random.gauss(0, 0.05), 2)
+        self.controls['CoolPowerPerc'] = max(0, min(100, round(self.controls['CoolPowerPerc'] + random.gauss(0, 1))))
+
+
+class AsiairSimulator:
+    def __init__(self, host='127.0.0.1', event_rates=EVENT_RATES, exposure_seconds=EXPOSURE_SECONDS,
+                 latency=0.0, jitter=0.0, frame_dimensions=FRAME_DIMENSIONS, frame_count=FRAME_COUNT,
+                 drop_rate=0.0, error_rate=0.0, garbage_rate=0.0, disconnect_rate=0.0, truncate_rate=0.0,
+                 image_bandwidth=None, seed=None):
+        self.host = host
+        self.event_rates = event_rates
+        self.exposure_seconds = exposure_seconds
+        self.latency = latency
+        self.jitter = jitter
+        self.frame_dimensions = frame_dimensions
+        self.frame_count = frame_count
+        # Fault injection: the chance of each, per request or image.
+        self.drop_rate = drop_rate
+        self.error_rate = error_rate
+        self.garbage_rate = garbage_rate
+        self.disconnect_rate = disconnect_rate
+        self.truncate_rate = truncate_rate
+        # Bytes per second on the image port, or None for as fast as possible.
+        self.image_bandwidth = image_bandwidth
+        self.random = random.Random(seed)
+        self.rig = SimulatedRig()
+        self.frames = []
+        self.frame_index = None
+        self.event_writers = set()
+        self.writers = set()
+        self.servers = []
+        self.tasks = []
+        self.answers = set()
+        self.stats = {'requests': 0, 'events': 0, 'images': 0, 'faults': 0}
+        self.methods = {
+            'test_connection': lambda: 'server connected!',
+            'pi_get_info': lambda: {
+                'guid': 'sim-' + self.host, 'cpuId': '00000000simulator', 'model': 'ASIAIR Simulator',
+                'uname': 'Linux asiair-sim', 'temp': 50.0,
+            },
+            'pi_station_state': lambda: {
+                'sig_lev': -55, 'freq': 5180, 'ssid': 'observatory', 'ip': self.host,
+                'gateway': '127.0.0.1', 'netmask': '255.0.0.0',
+            },
+            'get_power_supply': lambda: [[12.1, 0.5], [12.1, 0.8], [12.1, 0.0], [12.1, 0.0], [12.2, 2.4]],
+            'get_app_state': lambda: {'page': 'preview', 'is_avail': True},
+            'get_sequence_setting': lambda: {'group_name': 'M42'},
+            'get_camera_state': lambda: {'state': self.rig.camera_state, 'name': 'ZWO ASI2600MM Pro (sim)'},
+            'get_control_value': lambda name: {'name': name, 'value': self.rig.controls[name]},
+            'set_control_value': self._set_control_value,
+            'get_focuser_position': lambda: self.rig.focuser_position,
+            'get_wheel_slot_name': lambda: ['L', 'R', 'G', 'B', 'Ha', 'OIII', 'SII'],
+            'get_wheel_position': lambda: self.rig.wheel_position,
+            'scope_get_horiz_coord': lambda: [45.0 + self.random.gauss(0, 0.001), 180.0 + self.random.gauss(0, 0.001)],
+            'scope_get_ra_dec': lambda: [self.rig.ra, self.rig.dec],
+            'scope_get_pierside': lambda: 'pier_east',
+            'scope_get_track_mode': lambda: {'list': ['Sidereal', 'Lunar', 'Solar'], 'index': 0},
+            'scope_get_track_state': lambda: self.rig.tracking,
+            'scope_set_track_state': self._set_track_state,
+            'scope_get_location': lambda: [51.5, -0.1],
+            'scope_is_moving': lambda: 'none',
+        }
+
+    async def start(self):
+        (width, height) = self.frame_dimensions
+        # Zipping large frames is slow, so make them up front and cycle through them.
+        self.frames = await asyncio.to_thread(lambda: [
+            zipped_frame(synthetic_frame(width, height, seed=i, drift=2 * i)) for i in range(self.frame_count)])
+        for port in (4400, 4700):
+            self.servers.append(await asyncio.start_server(
+                lambda reader, writer, port=port: self._serve_rpc(port, reader, writer), self.host, port))
+        self.servers.append(await asyncio.start_server(self._serve_images, self.host, 4800))
+        for (event, rate) in self.event_rates.items():
+            if rate:
+                self.tasks.append(asyncio.create_task(self._emit(event, rate)))
+        if self.exposure_seconds:
+            self.tasks.append(asyncio.create_task(self._expose()))
+        logging.info('ASIAIR simulator listening on %s', self.host)
+
+    async def stop(self):
+        for task in self.tasks + list(self.answers):
+            task.cancel()
+        for server in self.servers:
+            server.close()
+        # Closing the connections lets their handlers finish.
+        for writer in list(self.writers):
+            writer.close()
+        for server in self.servers:
+            await server.wait_closed()
+
+    async def _delay(self):
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _fault(self, rate: float):
+        if rate and self.random.random() < rate:
+            self.stats['faults'] += 1
+            return True
+        return False
+
+    def _set_control_value(self, name, value):
+        self.rig.controls[name] = value
+        self.broadcast('CameraControlChange', {'name': name, 'value': value})
+        return 0
+
+    def _set_track_state(self, on):
+        self.rig.tracking = bool(on)
+        self.broadcast('ScopeTrack', {'state': 'on' if on else 'off'})
+        return 0
+
+    async def _serve_rpc(self, port: int, reader, writer):
+        self.writers.add(writer)
+        if port == 4700:
+            self.event_writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                answer = asyncio.create_task(self._answer(writer, json.loads(line)))
+                self.answers.add(answer)
+                answer.add_done_callback(self.answers.discard)
+        except (ConnectionError, ValueError) as ex:
+            logging.debug('Simulator port %d: %s', port, ex)
+        finally:
+            self.event_writers.discard(writer)
+            self.writers.discard(writer)
+            writer.close()
+
+    async def _answer(self, writer, request: dict):
+        self.stats['requests'] += 1
+        await self._delay()
+        if writer.is_closing() or self._fault(self.drop_rate):
+            return
+        if self._fault(self.disconnect_rate):
+            writer.close()
+            return
+        if self._fault(self.garbage_rate):
+            writer.write(b'<\xe8>{"not json\r\n')
+            return
+        method = request.get('method')
+        response = {'jsonrpc': '2.0', 'Timestamp': str(time.time()), 'method': method, 'id': request.get('id')}
+        handler = self.methods.get(method)
+        if handler is None or self._fault(self.error_rate):
+            response.update(code=1, error='simulated error' if handler else 'unknown method')
+        else:
+            try:
+                response.update(code=0, result=handler(*request.get('params', ())))
+            except Exception as ex:
+                # e.g. an unknown control name; answer with an error rather than not at all.
+                logging.debug('Simulator %s%s failed: %r', method, tuple(request.get('params', ())), ex)
+                response.update(code=1, error=str(ex))
+        writer.write((json.dumps(response) + '\r\n').encode())
+
+    def broadcast(self, event: str, fields: dict):
+        line = (json.dumps(dict({'Event': event, 'Timestamp': str(time.time())}, **fields)) + '\r\n').encode()
+        for writer in list(self.event_writers):
+            if not writer.is_closing():
+                writer.write(line)
+                self.stats['events'] += 1
+
+    def _event_fields(self, event: str):
+        if event == 'Temperature':
+            self.rig.step()
+            return {'value': self.rig.controls['Temperature']}
+        elif event == 'CoolerPower':
+            return {'value': self.rig.controls['CoolPowerPerc']}
+        elif event == 'GuideStep':
+            return {
+                'RADistanceRaw': round(self.random.gauss(0, 0.4), 3),
+                'DECDistanceRaw': round(self.random.gauss(0, 0.3), 3),
+                'RADuration': self.random.randint(0, 200),
+                'DECDuration': self.random.randint(0, 150),
+            }
+        elif event == 'PiStatus':
+            return {'temp': round(50 + self.random.gauss(0, 1), 1), 'is_overtemp': False, 'is_undervolt': False}
+        return {}
+
+    async def _emit(self, event: str, rate: float):
+        """ Events at rate per second on average, at exponentially distributed intervals. """
+        while True:
+            await asyncio.sleep(self.random.expovariate(rate))
+            self.broadcast(event, self._event_fields(event))
+
+    async def _expose(self):
+        index = 0
+        while True:
+            self.rig.camera_state = 'exposing'
+            self.broadcast('Exposure', {'state': 'start', 'exp_us': self.exposure_seconds * 1000 * 1000})
+            await asyncio.sleep(self.exposure_seconds)
+            self.frame_index = index % len(self.frames)
+            index += 1
+            self.rig.camera_state = 'idle'
+            self.broadcast('Exposure', {'state': 'complete'})
+
+    async def _serve_images(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await self._delay()
+                if self.frame_index is None:
+                    # Nothing taken yet: a header with no width.
+                    writer.write(IMAGE_HEADER.pack(0, 0, 0))
+                    continue
+                data = self.frames[self.frame_index]
+                if self._fault(self.truncate_rate):
+                    writer.write(data[:len(data) // 2])
+                    await writer.drain()
+                    break
+                await self._send_image(writer, data)
+                self.stats['images'] += 1
+        except ConnectionError as ex:
+            logging.debug('Simulator image port: %s', ex)
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def _send_image(self, writer, data: bytes):
+        if self.image_bandwidth is None:
+            writer.write(data)
+            await writer.drain()
+            return
+        chunk_size = max(1, int(self.image_bandwidth / 10))
+        for start in range(0, len(data), chunk_size):
+            writer.write(data[start:start + chunk_size])
+            await writer.drain()
+            await asyncio.sleep(0.1)
+
+
+def parse_rates(rates):
+    """ ['Temperature=50', ...] as {'Temperature': 50.0, ...}, over the defaults. """
+    event_rates = dict(EVENT_RATES)
+    for rate in rates:
+        (event, per_second) = rate.split('=')
+        event_rates[event] = float(per_second)
+    return event_rates
+
+
+async def run(args):
+    simulator = AsiairSimulator(
+        host=args.host,
+        event_rates=parse_rates(args.rate),
+        exposure_seconds=args.exposure,
+        latency=args.latency,
+        jitter=args.jitter,
+        frame_dimensions=tuple(int(n) for n in args.frame.split('x')),
+        drop_rate=args.drop,
+        error_rate=args.error,
+        garbage_rate=args.garbage,
+        disconnect_rate=args.disconnect,
+        truncate_rate=args.truncate,
+        image_bandwidth=args.bandwidth,
+        seed=args.seed)
+    await simulator.start()
+    while True:
+        await asyncio.sleep(STATS_INTERVAL_SECONDS)
+        logging.info('Simulator: %s', simulator.stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate an ASIAIR on ports 4400, 4700 and 4800.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--rate', action='append', default=[], metavar='EVENT=PER_SECOND',
+                        help='event rate, e.g. GuideStep=20; may be repeated')
+    parser.add_argument('--exposure', type=float, default=EXPOSURE_SECONDS, help='seconds per exposure, 0 for none')
+    parser.add_argument('--frame', default='{0}x{1}'.format(*FRAME_DIMENSIONS), metavar='WxH')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many seconds more')
+    parser.add_argument('--bandwidth', type=float, default=None, help='image port bytes per second')
+    parser.add_argument('--drop', type=float, default=0.0, help='chance a request is not answered')
+    parser.add_argument('--error', type=float, default=0.0, help='chance a request gets an error')
+    parser.add_argument('--garbage', type=float, default=0.0, help='chance a request gets a garbled line')
+    parser.add_argument('--disconnect', type=float, default=0.0, help='chance a request drops the connection')
+    parser.add_argument('--truncate', type=float, default=0.0, help='chance an image is cut short')
+    parser.add_argument('--seed', type=int, default=None)
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,133 +1,310 @@
 import asyncio
 
 from functools import partial
-import json
 import sys
 import logging
-import paho.mqtt.client as mqtt
-
-from asiair import ZwoAsiair
-from nina import Nina
-from stellarium import Stellarium
-
-logging.basicConfig(#filename="./ASIAIR_"+str(sys.argv[2])+".log",
-                    #filemode="a",
-                    format="%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s",
-                    datefmt="%H:%M:%S",
-                    level=logging.DEBUG,
-                    force=True)
-
-# get connection details from params
-asiair_host  = str(sys.argv[1])
-mqtt_host     = str(sys.argv[2])
-mqtt_port     = int(sys.argv[3])
-mqtt_username     = str(sys.argv[4])
-mqtt_password     = str(sys.argv[5])
-
-async def command_router(cmd_q: asyncio.Queue):
+
+from command_router import CommandRouter
+from const import (
+    BRIDGE_STATUS_TOPIC,
+    CONNECT_RETRY_MAX_SECONDS,
+    CONNECT_TIMEOUT_SECONDS,
+    DISCOVER_TIMEOUT_SECONDS,
+    DISCOVERY_OBJECT_ID_PREFIX,
+    DISCOVERY_RETAINED_WAIT_SECONDS,
+    DISCOVERY_TOPIC_ROOT,
+    HA_STATUS_ONLINE,
+    HA_STATUS_TOPIC,
+    PAYLOAD_AVAILABLE,
+    PAYLOAD_NOT_AVAILABLE,
+    PUBLISH_STATS_INTERVAL_SECONDS,
+    STATE_DOCUMENT_ENABLED,
+)
+from fleet import create_connections, legacy_config, load_config
+from hass_mqtt import LastValueCache, PublishedSnapshot, PublishThrottle, RetainedDiscovery, StateDocument, command_state_topic, discovery_payload
+from http_server import HttpServer
+import metrics
+from mqtt_client import AsyncMqttClient, PublishBuffer
+from scheduler import PollScheduler
+from topic_trie import TopicTrie
+
+async def report_publish_stats(cache: LastValueCache, throttle: PublishThrottle, buffer: PublishBuffer, router: CommandRouter):
+    while True:
+        await asyncio.sleep(PUBLISH_STATS_INTERVAL_SECONDS)
+        logging.info('MQTT publishes: %d sent, %d unchanged and suppressed, %d throttled',
+            cache.published, cache.suppressed, throttle.throttled)
+        if len(buffer) or buffer.flushed:
+            logging.info('MQTT buffer: %d topics (%d bytes) waiting, %d sent after reconnect, %d spilled, %d dropped',
+                len(buffer), buffer.bytes, buffer.flushed, buffer.spilled, buffer.dropped)
+        for (device, (depth, stats)) in router.stats().items():
+            logging.info('Commands for %s: %d queued, %d received, %d coalesced, %d failed, %d rolled back, %.3fs mean / %.3fs max latency',
+                device, depth, stats.received, stats.coalesced, stats.failed, stats.rolled_back, stats.mean_latency(), stats.max_latency)
+
+CONNECT_FAILURES = metrics.counter(
+    'astro_mqtt_connect_failures_total', 'Failed attempts to connect to and discover a connection.', ('connection',))
+RECONNECTS = metrics.counter(
+    'astro_mqtt_connection_reconnects_total', 'Connections attached again after being lost, e.g. the ASIAIR RPC ports.', ('connection',))
+
+def register_metrics(connections, cache: LastValueCache, throttle: PublishThrottle, buffer: PublishBuffer, router: CommandRouter):
+    """ Metrics read at scrape time from counts that are already kept elsewhere. """
+    def queue_depths():
+        depths = {}
+        for (cnx_name, cnx) in connections.items():
+            for queue in ('cmd_q_4400', 'cmd_q_4700', 'event_q'):
+                if hasattr(cnx, queue):
+                    depths[(cnx_name, queue)] = getattr(cnx, queue).qsize()
+        return depths
+
+    def image_reconnects():
+        return {
+            (cnx_name,): cnx.image_channel.reconnects
+            for (cnx_name, cnx) in connections.items() if hasattr(cnx, 'image_channel')
+        }
+
+    def command_counts():
+        counts = {}
+        for (device, (_, stats)) in router.stats().items():
+            for result in ('received', 'coalesced', 'completed', 'failed', 'rolled_back'):
+                counts[(device, result)] = getattr(stats, result)
+        return counts
+
+    metrics.gauge('astro_mqtt_queue_depth', 'Items waiting in a connection\'s internal queues.',
+        ('connection', 'queue'), fn=queue_depths)
+    metrics.gauge('astro_mqtt_command_queue_depth', 'MQTT commands waiting for a device.',
+        ('device',), fn=lambda: {(device,): depth for (device, (depth, _)) in router.stats().items()})
+    metrics.counter('astro_mqtt_commands_total', 'MQTT commands by what became of them.',
+        ('device', 'result'), fn=command_counts)
+    metrics.counter('astro_mqtt_image_channel_reconnects_total', 'Reconnections of the ASIAIR image port.',
+        ('connection',), fn=image_reconnects)
+    metrics.counter('astro_mqtt_state_publishes_total', 'State updates by whether they were sent.',
+        ('result',), fn=lambda: {
+            ('sent',): cache.published, ('unchanged',): cache.suppressed, ('throttled',): throttle.throttled})
+    metrics.gauge('astro_mqtt_mqtt_buffered_topics', 'Topics buffered while the broker is unreachable.',
+        fn=lambda: {(): len(buffer)})
+    metrics.gauge('astro_mqtt_mqtt_buffered_bytes', 'Payload bytes buffered while the broker is unreachable.',
+        fn=lambda: {(): buffer.bytes})
+
+def command_topic_root(cnx_name):
+    # Commands get their own subtree so the wildcard subscription doesn't echo state back.
+    return '{0}/set'.format(cnx_name)
+
+def discovery_topic(cnx_name, device):
+    return '{0}/{1}_{2}_{3}/config'.format(DISCOVERY_TOPIC_ROOT, DISCOVERY_OBJECT_ID_PREFIX, cnx_name, device.name)
+
+def legacy_discovery_root(cnx_name):
+    # Earlier versions published {root}/astro_mqtt/{cnx}/config, one config per
+    # connection, then {root}/astro_mqtt/{cnx}/{device}/config, which HA ignores.
+    return '{0}/{1}/{2}/'.format(DISCOVERY_TOPIC_ROOT, DISCOVERY_OBJECT_ID_PREFIX, cnx_name)
+
+def availability_topic(cnx_name, device):
+    return '{0}/{1}/availability'.format(cnx_name, device.name)
+
+async def attach(cnx_name, cnx):
+    """ Connect to and discover cnx, retrying in the background until it answers. """
+    backoff = 1
     while True:
         try:
-            (device, component, topic, fn, payload) = await cmd_q.get()
-            try:
-                payload = json.loads(payload)
-            except json.JSONDecodeError:
-                payload = payload.decode() # just use the string
-            try:
-                new_value = await fn(device, payload)
-                if new_value is not None:
-                    component.on_publish(component, topic, new_value)
-            except NotImplementedError:
-                logging.error('Not implemented - command for "%s"', topic)
-            cmd_q.task_done()
+            logging.info('Opening connections for "%s"', cnx_name)
+            await asyncio.wait_for(cnx.connect(), CONNECT_TIMEOUT_SECONDS)
+            logging.info('Discovering devices for "%s"', cnx_name)
+            return await asyncio.wait_for(cnx.discover(), DISCOVER_TIMEOUT_SECONDS)
         except Exception as ex:
-            logging.error(ex)
-
-async def main():
-    cmd_q = asyncio.Queue()
-    connections = {
-        'asiair': ZwoAsiair.create('ASIAIR', address=asiair_host),
-        'nina': Nina.create('NINA', host='astrobee'),
-        'stellarium': Stellarium.create('Stellarium Mac', host='MacStudio'),
-        'planetarium': Stellarium.create('Planetarium', host='ObservatoryMiniPC')
-    }
-    for name, cnx in connections.items():
-        # We run this sequentially as parallel connection creation
-        # creates messy logs which are hard to debug.
-        logging.info('Opening connections for "%s"', name)
-        await cnx.connect()
+            CONNECT_FAILURES.inc(connection=cnx_name)
+            logging.warning('"%s" is unavailable, retrying in %ds: %s', cnx_name, backoff, repr(ex))
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, CONNECT_RETRY_MAX_SECONDS)
+
+async def main(config):
+    mqtt_host     = config['mqtt']['host']
+    mqtt_port     = config['mqtt']['port']
+    mqtt_username     = config['mqtt'].get('username')
+    mqtt_password     = config['mqtt'].get('password')
+    router = CommandRouter()
+    publish_cache = LastValueCache()
+    publish_throttle = PublishThrottle()
+    connections = create_connections(config)
 
     logging.info("Connecting MQTT: %s : %d", mqtt_host, mqtt_port)
-    clientMQTT = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2, userdata=connections)
-    if mqtt_username and mqtt_password:
-        clientMQTT.username_pw_set(username=mqtt_username, password=mqtt_password)
-    clientMQTT.connect(mqtt_host, mqtt_port, 60)
-    clientMQTT.loop_start()
-    logging.info("Discovering devices...")
-
-    all_devices = []
+    clientMQTT = AsyncMqttClient(userdata=connections)
+    clientMQTT.will_set(BRIDGE_STATUS_TOPIC, PAYLOAD_NOT_AVAILABLE, qos=1, retain=True)
+    await clientMQTT.connect(mqtt_host, mqtt_port, mqtt_username, mqtt_password)
+    await clientMQTT.publish(BRIDGE_STATUS_TOPIC, PAYLOAD_AVAILABLE, qos=1, retain=True)
+    # The broker sends our will if the connection drops, so say we're back when it returns.
+    status_tasks = set()
+    def on_reconnect():
+        task = asyncio.create_task(clientMQTT.publish(BRIDGE_STATUS_TOPIC, PAYLOAD_AVAILABLE, qos=1, retain=True))
+        status_tasks.add(task)
+        task.add_done_callback(status_tasks.discard)
+    clientMQTT.connect_listeners.append(on_reconnect)
+    publish_buffer = PublishBuffer(clientMQTT)
+    snapshot = PublishedSnapshot()
+
+    async def publish_state(topic, payload, qos=0, retain=False):
+        snapshot.record(topic, payload, qos=qos, retain=retain)
+        await publish_buffer.publish(topic, payload, qos=qos, retain=retain)
+
+    def on_ha_status(client, userdata, message):
+        # A retained "online" arrives on every (re)subscribe, not just when HA restarts.
+        if message.payload == HA_STATUS_ONLINE.encode() and not message.retain:
+            snapshot.republish(publish_buffer.publish)
+    clientMQTT.subscribe(HA_STATUS_TOPIC, on_ha_status)
+
+    # Collect the discovery configs retained from the last run, so unchanged ones aren't re-sent.
+    retained_discovery = RetainedDiscovery('{0}/{1}'.format(DISCOVERY_TOPIC_ROOT, DISCOVERY_OBJECT_ID_PREFIX))
+    discovery_filters = [DISCOVERY_TOPIC_ROOT + '/+/config', '{0}/{1}/#'.format(DISCOVERY_TOPIC_ROOT, DISCOVERY_OBJECT_ID_PREFIX)]
+    for discovery_filter in discovery_filters:
+        clientMQTT.subscribe(discovery_filter, retained_discovery.on_message)
+    await asyncio.sleep(DISCOVERY_RETAINED_WAIT_SECONDS)
+    for discovery_filter in discovery_filters:
+        clientMQTT.unsubscribe(discovery_filter)
+    logging.info('Found %d retained discovery configs', len(retained_discovery.topics()))
+
+    # Remove the configs of earlier versions; the per-device configs replace them.
+    for cnx_name in connections:
+        for legacy_topic in retained_discovery.topics():
+            if legacy_topic.startswith(legacy_discovery_root(cnx_name)):
+                logging.info('Removing legacy discovery config %s', legacy_topic)
+                retained_discovery.forget(legacy_topic)
+                await clientMQTT.publish(legacy_topic, '', qos=1, retain=True)
+
+    # Everything is unavailable until its connection has been attached.
     for cnx_name, cnx in connections.items():
-        device_list = await cnx.discover()
-        for device in device_list.values():
-            all_devices.append((cnx_name, device))
+        for device in cnx.devices.values():
+            await publish_state(availability_topic(cnx_name, device), PAYLOAD_NOT_AVAILABLE, qos=1, retain=True)
+
+    # Commands arrive on one wildcard subscription per connection and are
+    # looked up here, rather than having a subscription per command topic.
+    commands = TopicTrie()
+
+    def on_command(client, userdata, message):
+        handler = commands.lookup(message.topic)
+        if handler is None:
+            logging.debug('No handler for command topic %s', message.topic)
+            return
+        (device, component, fn, state_topic) = handler
+        logging.debug('Command for %s %s %s %s', device.name, message.topic, fn, message.payload)
+        router.submit(device, component, message.topic, fn, message.payload, state_topic)
+
+    for cnx_name in connections:
+        clientMQTT.subscribe(command_topic_root(cnx_name) + '/#', on_command)
 
-    for (cnx_name, device) in all_devices:
+    async def on_publish(mqtt_component, topic, payload, state_topics, document):
+        state_topic = state_topics[(mqtt_component.component_id, topic)]
+        if not publish_cache.should_publish(state_topic, payload, mqtt_component.deadband):
+            return
+        if document is not None and document.contains(mqtt_component.component_id):
+            document.update(mqtt_component.component_id, topic, payload)
+        else:
+            send = partial(publish_state, qos=mqtt_component.qos, retain=mqtt_component.retain)
+            await publish_throttle.publish(state_topic, payload, mqtt_component.min_interval, send)
+
+    async def register(cnx_name, device):
         dv = device.get_mqtt_device_config()
-        discovery_topic = 'homeassistant/device/astro_mqtt/{0}/config'.format(cnx_name) # remove hard coding
+        device_discovery_topic = discovery_topic(cnx_name, device)
         logging.debug(type(device).__name__ + ': ' + str(dv))
         components = {}
-        #for component in device.components():
         device_root_topic = '{cnx_name}/{device_name}'.format(cnx_name=cnx_name, device_name=device.name)
+        device.bind_topics(device_root_topic, '{0}/{1}'.format(command_topic_root(cnx_name), device.name))
+        document = None
+        if STATE_DOCUMENT_ENABLED:
+            document = StateDocument(
+                device_root_topic + '/document',
+                device.component_table,
+                partial(publish_state, qos=1, retain=True))
+
+        for spec in device.component_table:
+            component = spec.component
+            # Components can be shared between device classes, so don't modify their config.
+            config = dict(component.component_config)
+
+            for topic in spec.state_topics:
+                config[topic.config_key] = device.state_topics[(spec.component_id, topic.topic)]
+                logging.debug('Registering: ' + type(device).__name__ + ': ' + topic.topic)
+
+            for topic in spec.command_topics:
+                command_topic = device.command_topics[(spec.component_id, topic.topic)]
+                config[topic.config_key] = command_topic
+                logging.debug('Routing %s to %s', command_topic, spec.component_id)
+                commands.insert(command_topic, (device, component, topic.fn, command_state_topic(component, topic.topic)))
 
-        for component in device.mqtt_components:
-            config = component.component_config
-            component_root_topic = '{device_root_topic}/{component_id}'.format(device_root_topic=device_root_topic, component_id=component.component_id)
-
-            for topic in component.subscription_topic_map.keys():
-                if topic == '':
-                    config['topic'] = component_root_topic
-                else:
-                    config[topic + '_topic'] = component_root_topic + '/' + topic
-                logging.debug('Registering: ' + type(device).__name__ + ': ' + topic)
-
-            def callback(client, userdata, message, device, component, topic, fn, cmd_q):
-                logging.debug('Callback for %s %s %s %s', device.name, topic, fn, message.payload)
-                cmd_q.put_nowait((device, component, topic, fn, message.payload))
-
-            for topic, fn in component.command_topic_map.items():
-                command_topic = component_root_topic + '/' + topic
-                config[topic + '_topic'] = command_topic
-                logging.info('Subscribing to %s for %s', command_topic, component.component_id)
-
-                clientMQTT.subscribe(command_topic)
-                topic_callback = partial(callback, device=device, component=component, topic=command_topic, fn=fn, cmd_q=cmd_q)
-                topic_callback.__name__ = 'partial'
-                clientMQTT.message_callback_add(
-                    command_topic,
-                    topic_callback
-                    )
-            
-            config['unique_id'] = '{0}.{1}.{2}'.format(cnx_name, device.uuid(), component.component_id)
-            components[component.component_id] = config
-            #component.set_on_publish(lambda component, topic, payload, root_topic=component_root_topic: clientMQTT.publish(root_topic + ('' if topic == '' else '/' + topic ), payload, qos=1))
-        
-        def on_publish(mqtt_component, topic, payload, device_root_topic):
-            clientMQTT.publish(device_root_topic + '/' + mqtt_component.component_id + ('' if topic == '' else '/' + topic ), payload, qos=1)
-        device.on_publish = partial(on_publish, device_root_topic=device_root_topic)
-        
-        discovery_payload = {
+            if document is not None and document.contains(spec.component_id):
+                document.component_config(spec, config)
+            config['unique_id'] = '{0}.{1}.{2}'.format(cnx_name, device.uuid(), spec.component_id)
+            components[spec.component_id] = config
+
+        device.on_publish = partial(on_publish, state_topics=device.state_topics, document=document)
+
+        device_config = {
             'dev': dv,
             'o': {
                 'name': 'AstroMQTT',
                 'sw_version': '0.1',
                 'support_url': 'https://github.com/ashleywbrown/asiair-mqtt',
             },
+            'availability': [
+                {'topic': BRIDGE_STATUS_TOPIC},
+                {'topic': availability_topic(cnx_name, device)},
+            ],
+            'availability_mode': 'all',
             'cmps': components,
         }
-        logging.debug(' Registering device %s', discovery_payload)
-        clientMQTT.publish(discovery_topic, json.dumps(discovery_payload), qos=0, retain=True)
-    
-    polling = list(map(lambda cnx: cnx.poll(), connections.values()))
-    logging.info("Starting... %d", len(polling))
-    await asyncio.gather(command_router(cmd_q), *polling)
-
-asyncio.run(main())
\ No newline at end of file
+        payload = discovery_payload(device_config)
+        snapshot.record(device_discovery_topic, payload, qos=1, retain=True, discovery=True)
+        if retained_discovery.should_publish(device_discovery_topic, payload):
+            logging.debug(' Registering device %s', device_config)
+            await publish_buffer.publish(device_discovery_topic, payload, qos=1, retain=True)
+        else:
+            logging.info('Discovery for %s/%s is unchanged', cnx_name, device.name)
+
+    scheduler = PollScheduler()
+
+    async def start_connection(cnx_name, cnx):
+        registered = set()
+        while True:
+            device_list = await attach(cnx_name, cnx)
+            if registered:
+                RECONNECTS.inc(connection=cnx_name)
+            for device in device_list.values():
+                if device.name not in registered:
+                    await register(cnx_name, device)
+                    scheduler.add_device(device)
+                    registered.add(device.name)
+                await publish_state(availability_topic(cnx_name, device), PAYLOAD_AVAILABLE, qos=1, retain=True)
+            logging.info('"%s" attached with %d devices', cnx_name, len(device_list))
+            await cnx.poll()
+            logging.warning('Lost the connection to "%s", attaching again', cnx_name)
+            for device in device_list.values():
+                await publish_state(availability_topic(cnx_name, device), PAYLOAD_NOT_AVAILABLE, qos=1, retain=True)
+
+    register_metrics(connections, publish_cache, publish_throttle, publish_buffer, router)
+    http_server = HttpServer()
+    http_server.add_routes('', metrics.http_routes())
+    for cnx_name, cnx in connections.items():
+        http_server.add_routes('/' + cnx_name, cnx.http_routes())
+    await http_server.start()
+
+    # Connections attach independently, so one offline host doesn't hold up the others.
+    starting = [start_connection(cnx_name, cnx) for cnx_name, cnx in connections.items()]
+    logging.info("Starting... %d", len(starting))
+    try:
+        await asyncio.gather(report_publish_stats(publish_cache, publish_throttle, publish_buffer, router), scheduler.run(), *starting)
+    finally:
+        for cnx in connections.values():
+            await cnx.close()
+        await http_server.stop()
+
+if __name__ == '__main__':
+    logging.basicConfig(#filename="./ASIAIR_"+str(sys.argv[2])+".log",
+                        #filemode="a",
+                        format="%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s",
+                        datefmt="%H:%M:%S",
+                        level=logging.DEBUG,
+                        force=True)
+
+    # Either: astro_mqtt.py <config.json>
+    #     or: astro_mqtt.py <asiair host> <mqtt host> <mqtt port> <mqtt username> <mqtt password>
+    if len(sys.argv) == 2:
+        config = load_config(sys.argv[1])
+    else:
+        config = legacy_config(*sys.argv[1:6])
+    asyncio.run(main(config))
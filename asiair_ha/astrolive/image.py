@@ -31,18 +31,36 @@ class ImageManipulation:
     # Normalize the image data
     # #########################################################################
     @staticmethod
-    async def normalize_image(image):
+    def normalize_image(image):
         return np.divide(image, (2**CAMERA_SAMPLE_RESOLUTION)-1)
 
+    # #########################################################################
+    # Software Binning
+    # #########################################################################
+    @staticmethod
+    def bin_factor(image):
+        """Largest binning that keeps the image at least IMAGE_PUBLISH_DIMENSIONS."""
+        h, w = image.shape
+        target_w, target_h = IMAGE_PUBLISH_DIMENSIONS
+        return max(1, min(w // target_w, h // target_h))
+
+    @staticmethod
+    def bin_image(image, factor):
+        """Average factor x factor blocks into a float32 image, cropping any remainder."""
+        h, w = image.shape
+        bh, bw = h // factor, w // factor
+        blocks = image[: bh * factor, : bw * factor].reshape(bh, factor, bw, factor)
+        return blocks.mean(axis=(1, 3), dtype=np.float32)
+
     # #########################################################################
     # PixInsight STF Stretch
     # #########################################################################
     @staticmethod
-    async def midtones_transfer_function(x, m):
+    def midtones_transfer_function(x, m):
         return (m - 1) * x / ((2 * m - 1) * x - m)
 
     @staticmethod
-    async def compute_stf_stretch(image, target_background=STRETCH_STF_TARGET_BACKGROUND):
+    def compute_stf_stretch(image, target_background=STRETCH_STF_TARGET_BACKGROUND):
         """
         Apply a PixInsight-like Screen Transfer Function (STF) to a grayscale image.
 
@@ -80,13 +98,13 @@ class ImageManipulation:
 
         # Compute midtones balance
         mc = (
-            await ImageManipulation.midtones_transfer_function((Mc - sc), B)
+            ImageManipulation.midtones_transfer_function((Mc - sc), B)
             if ac == 0
-            else await ImageManipulation.midtones_transfer_function(B, (hc - Mc))
+            else ImageManipulation.midtones_transfer_function(B, (hc - Mc))
         )
 
         # Stretch using midtones transfer function
-        M = await ImageManipulation.midtones_transfer_function(x, mc)
+        M = ImageManipulation.midtones_transfer_function(x, mc)
 
         logging.debug(f"MC: {Mc:.8f}, MADNc: {MADNc:.8f}, B: {B}, C: {C}, ac: {ac}, sc: {sc:.8f}, hc: {hc:.8f}")
 
@@ -96,7 +114,7 @@ class ImageManipulation:
     # AstroPy Stretch
     # #########################################################################
     @staticmethod
-    async def compute_astropy_stretch(
+    def compute_astropy_stretch(
         image,
         stretch=STRETCH_AP_STRETCH_FUNCTION,
         minmax_percent=STRETCH_AP_MINMAX_PERCENT,
@@ -165,7 +183,7 @@ class ImageManipulation:
     # Downscale Image
     # #########################################################################
     @staticmethod
-    async def resize_image(image):
+    def resize_image(image):
         image_uint8 = (image * 255).astype(np.uint8)
 
         h, w = image_uint8.shape
@@ -0,0 +1,292 @@
+""" Throughput and latency from an ASIAIR event arriving to its MQTT publish.
+
+Runs the whole bridge (astro_mqtt.main) against the ASIAIR simulator and a
+stub MQTT broker. Both stand-ins run on their own thread and event loop, so
+the bridge's CPU time can be measured on its own. Temperature events carry
+a sequence number as their value, which comes back as the camera's
+current_temperature state.
+
+First a burst of events is sent at once, for the rate the bridge can sustain
+and its CPU time per thousand events. Then events are sent at a steady rate,
+well below that, for the latency of a single event. Event rate limiting
+(EVENT_AGGREGATION) is turned off so that every event is published.
+
+With --check, exits non-zero if any event is lost or a result is worse than
+the CHECK_ limits, for catching hot path regressions in CI. The limits are
+loose, to allow for slow CI machines.
+
+Usage: python benchmarks/end_to_end.py [burst events] [steady events] [steady rate] [--check]
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import asiair
+import astro_mqtt
+from asiair_simulator import AsiairSimulator
+
+SIMULATOR_HOST = '127.0.0.3'
+CONNECTION = 'bench'
+READY_TIMEOUT_SECONDS = 60
+WARMUP_SECONDS = 3
+DELIVERY_TIMEOUT_SECONDS = 60
+
+CHECK_MIN_EVENTS_PER_SECOND = 500
+CHECK_MAX_P99_MS = 200
+CHECK_MAX_CPU_MS_PER_1000 = 1500
+
+# MQTT 3.1.1 control packet types.
+CONNECT = 1
+PUBLISH = 3
+SUBSCRIBE = 8
+UNSUBSCRIBE = 10
+PINGREQ = 12
+DISCONNECT = 14
+
+
+class StubBroker:
+    """ Just enough of an MQTT broker to accept the bridge's connection and publishes.
+
+    Nothing is forwarded or retained; on_publish(topic, payload) is called
+    for each message received.
+    """
+    def __init__(self, on_publish):
+        self.on_publish = on_publish
+        self.server = None
+        self.port = None
+        self.handlers = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        for (handler, writer) in list(self.handlers):
+            writer.close()
+        await asyncio.gather(*[handler for (handler, _) in self.handlers])
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        handler = (asyncio.current_task(), writer)
+        self.handlers.add(handler)
+        try:
+            while True:
+                (header,) = await reader.readexactly(1)
+                length = 0
+                for shift in range(0, 28, 7):
+                    (byte,) = await reader.readexactly(1)
+                    length |= (byte & 0x7f) << shift
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                packet_type = header >> 4
+                if packet_type == CONNECT:
+                    writer.write(bytes([0x20, 2, 0, 0]))
+                elif packet_type == PUBLISH:
+                    qos = (header >> 1) & 3
+                    topic_length = int.from_bytes(body[:2], 'big')
+                    topic = body[2:2 + topic_length].decode()
+                    payload = body[2 + topic_length + (2 if qos else 0):]
+                    if qos:
+                        writer.write(bytes([0x40, 2]) + body[2 + topic_length:4 + topic_length])
+                    self.on_publish(topic, payload)
+                elif packet_type == SUBSCRIBE:
+                    # Grant each filter the qos it asked for, up to 1.
+                    (position, granted) = (2, bytearray())
+                    while position < len(body):
+                        filter_length = int.from_bytes(body[position:position + 2], 'big')
+                        granted.append(min(body[position + 2 + filter_length], 1))
+                        position += 3 + filter_length
+                    writer.write(bytes([0x90, 2 + len(granted)]) + body[:2] + granted)
+                elif packet_type == UNSUBSCRIBE:
+                    writer.write(bytes([0xb0, 2]) + body[:2])
+                elif packet_type == PINGREQ:
+                    writer.write(bytes([0xd0, 0]))
+                elif packet_type == DISCONNECT:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.handlers.discard(handler)
+            writer.close()
+
+
+class StandIns(threading.Thread):
+    """ The simulator, the broker and the event driver, on their own loop. """
+    def __init__(self, burst: int, steady: int, rate: float):
+        super().__init__(daemon=True)
+        self.burst = burst
+        self.steady = steady
+        self.rate = rate
+        self.broker_port = concurrent.futures.Future()
+        self.measuring = concurrent.futures.Future()
+        self.burst_done = concurrent.futures.Future()
+        self.finished = concurrent.futures.Future()
+        # Set once the bridge has shut down, so the stand-ins can too.
+        self.stop = concurrent.futures.Future()
+        self.sent = {}
+        self.received = {}
+
+    def run(self):
+        try:
+            asyncio.run(self._run())
+        except Exception as ex:
+            for future in (self.broker_port, self.measuring, self.burst_done, self.finished):
+                if not future.done():
+                    future.set_exception(ex)
+
+    def _on_publish(self, topic: str, payload: bytes):
+        now = time.perf_counter()
+        if topic == '{0}/camera/availability'.format(CONNECTION) and payload == b'online':
+            self.available.set()
+        if not topic.endswith('/current_temperature'):
+            return
+        try:
+            value = int(float(payload))
+        except ValueError:
+            return
+        if value in self.sent and value not in self.received:
+            self.received[value] = now
+            if len(self.received) == self.expected:
+                self.delivered.set()
+
+    async def _send(self, first: int, count: int, rate=None):
+        """ Send events first..first + count - 1 and wait for their publishes. Returns the time taken. """
+        self.expected = first + count
+        self.delivered = asyncio.Event()
+        started = time.perf_counter()
+        for value in range(first, first + count):
+            if rate:
+                delay = started + (value - first) / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.sent[value] = time.perf_counter()
+            self.simulator.broadcast('Temperature', {'value': value})
+        try:
+            await asyncio.wait_for(self.delivered.wait(), DELIVERY_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        return max([self.received[value] for value in range(first, first + count) if value in self.received], default=started) - started
+
+    def _latencies(self, first: int, count: int):
+        return sorted(
+            self.received[value] - self.sent[value]
+            for value in range(first, first + count) if value in self.received)
+
+    async def _run(self):
+        self.available = asyncio.Event()
+        broker = StubBroker(self._on_publish)
+        await broker.start()
+        self.simulator = AsiairSimulator(SIMULATOR_HOST, event_rates={}, exposure_seconds=0, frame_dimensions=(64, 64))
+        await self.simulator.start()
+        self.broker_port.set_result(broker.port)
+
+        await asyncio.wait_for(self.available.wait(), READY_TIMEOUT_SECONDS)
+        await asyncio.sleep(WARMUP_SECONDS)
+
+        self.measuring.set_result(None)
+        burst_seconds = await self._send(0, self.burst)
+        self.burst_done.set_result(None)
+        await self._send(self.burst, self.steady, self.rate)
+        self.finished.set_result({
+            'burst_seconds': burst_seconds,
+            'burst': self._latencies(0, self.burst),
+            'steady': self._latencies(self.burst, self.steady),
+        })
+
+        await asyncio.wrap_future(self.stop)
+        await self.simulator.stop()
+        await broker.close()
+
+
+async def wait_for_bridge(bridge: asyncio.Task, future: concurrent.futures.Future):
+    """ The future's result, unless the bridge stops first. """
+    waiting = asyncio.wrap_future(future)
+    await asyncio.wait([bridge, waiting], return_when=asyncio.FIRST_COMPLETED)
+    if not waiting.done():
+        waiting.cancel()
+        bridge.result()
+        raise RuntimeError('The bridge stopped')
+    return waiting.result()
+
+
+async def run_bridge(standins: StandIns):
+    config = {
+        'mqtt': {'host': '127.0.0.1', 'port': await asyncio.wrap_future(standins.broker_port)},
+        'connections': {CONNECTION: {'type': 'asiair', 'name': 'Benchmark', 'address': SIMULATOR_HOST}},
+    }
+    bridge = asyncio.create_task(astro_mqtt.main(config))
+    await wait_for_bridge(bridge, standins.measuring)
+    cpu = time.thread_time()
+    await wait_for_bridge(bridge, standins.burst_done)
+    cpu = time.thread_time() - cpu
+    results = await wait_for_bridge(bridge, standins.finished)
+    bridge.cancel()
+    try:
+        await bridge
+    except asyncio.CancelledError:
+        pass
+    results['burst_cpu_seconds'] = cpu
+    return results
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+def main():
+    check = '--check' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != '--check']
+    burst = int(args[0]) if len(args) > 0 else 5000
+    steady = int(args[1]) if len(args) > 1 else 1000
+    rate = float(args[2]) if len(args) > 2 else 200
+
+    logging.basicConfig(level=logging.WARNING)
+    # Measure the event path itself, not the rate limiting in front of it.
+    asiair.EVENT_AGGREGATION = {}
+
+    standins = StandIns(burst, steady, rate)
+    standins.start()
+    try:
+        results = asyncio.run(run_bridge(standins))
+    finally:
+        standins.stop.set_result(None)
+        standins.join()
+
+    events_per_second = len(results['burst']) / results['burst_seconds'] if results['burst_seconds'] else float('nan')
+    cpu_ms_per_1000 = results['burst_cpu_seconds'] * 1000 * 1000 / burst
+    steady_p50_ms = percentile(results['steady'], 0.5) * 1000
+    steady_p99_ms = percentile(results['steady'], 0.99) * 1000
+    lost = burst + steady - len(results['burst']) - len(results['steady'])
+    print('burst   {0:>6} events  {1:>8.0f} events/s  {2:>8.1f} CPU ms per 1000  p50 {3:>8.2f} ms  p99 {4:>8.2f} ms'.format(
+        burst, events_per_second, cpu_ms_per_1000,
+        percentile(results['burst'], 0.5) * 1000, percentile(results['burst'], 0.99) * 1000))
+    print('steady  {0:>6} events  {1:>8.0f} events/s  {2:>28}  p50 {3:>8.2f} ms  p99 {4:>8.2f} ms'.format(
+        steady, rate, '', steady_p50_ms, steady_p99_ms))
+    print('lost    {0:>6} events'.format(lost))
+
+    if check:
+        failures = []
+        if lost:
+            failures.append('{0} events were not published'.format(lost))
+        if not events_per_second >= CHECK_MIN_EVENTS_PER_SECOND:
+            failures.append('{0:.0f} events/s is below {1}'.format(events_per_second, CHECK_MIN_EVENTS_PER_SECOND))
+        if not steady_p99_ms <= CHECK_MAX_P99_MS:
+            failures.append('p99 latency {0:.2f} ms is over {1}'.format(steady_p99_ms, CHECK_MAX_P99_MS))
+        if not cpu_ms_per_1000 <= CHECK_MAX_CPU_MS_PER_1000:
+            failures.append('{0:.1f} CPU ms per 1000 events is over {1}'.format(cpu_ms_per_1000, CHECK_MAX_CPU_MS_PER_1000))
+        for failure in failures:
+            print('FAIL: ' + failure)
+        sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+""" CPU and memory per rig when running several ASIAIRs in one process.
+
+Each rig count runs in a fresh process. Every rig processes the same number
+of synthetic light frames through the shared image pool (bin, calibrate,
+stretch, PNG encode, live stack, frame history), all rigs at once. Network
+I/O is left out: the frames are generated, not downloaded.
+
+Usage: python benchmarks/fleet_scaling.py [rig counts, e.g. 1,2,4,8] [frames per rig] [WxH]
+"""
+
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+def rss_mb():
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def synthetic_frame(width, height, seed):
+    import cv2
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    frame = rng.normal(1000, 30, (height, width)).astype(np.float32)
+    stars = np.zeros((height, width), dtype=np.float32)
+    stars[rng.integers(0, height, 300), rng.integers(0, width, 300)] = rng.uniform(2e4, 6e5, 300)
+    frame += cv2.GaussianBlur(stars, (0, 0), 2)
+    return np.clip(frame, 0, 65535).astype(np.uint16)
+
+
+async def run_rigs(rigs, frames, width, height):
+    from astrolive.image import ImageManipulation
+    from calibration import FRAME_TYPE_LIGHT, CalibrationKey
+    from fleet import create_connections
+    from image_workers import run_image_job
+
+    started_rss = rss_mb()
+    connections = create_connections({'connections': {
+        'rig{0}'.format(i): {'type': 'asiair', 'address': 'localhost'} for i in range(rigs)
+    }})
+    idle_rss = rss_mb()
+
+    raw = synthetic_frame(width, height, 0)
+    factor = ImageManipulation.bin_factor(raw)
+    key = CalibrationKey('bench', 100, 10, '{0}x{1}_bin{2}'.format(width, height, factor), 0)
+
+    async def run(rig):
+        for _ in range(frames):
+            (preview, png, _) = await run_image_job(rig._process_frame, raw, factor, FRAME_TYPE_LIGHT, key)
+            rig.frame_history.add(preview, bytearray(png))
+
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    await asyncio.gather(*[run(rig) for rig in connections.values()])
+    return {
+        'rigs': rigs,
+        'frames': rigs * frames,
+        'wall_s': time.perf_counter() - wall,
+        'cpu_s': time.process_time() - cpu,
+        'idle_mb_per_rig': (idle_rss - started_rss) / rigs,
+        'rss_mb': rss_mb(),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        (rigs, frames, width, height) = map(int, sys.argv[2:6])
+        print(json.dumps(asyncio.run(run_rigs(rigs, frames, width, height))))
+        return
+
+    rig_counts = [int(n) for n in (sys.argv[1] if len(sys.argv) > 1 else '1,2,4').split(',')]
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    (width, height) = map(int, (sys.argv[3] if len(sys.argv) > 3 else '3008x3008').split('x'))
+
+    print('{0} frames per rig, {1}x{2}'.format(frames, width, height))
+    print('{0:>5} {1:>9} {2:>12} {3:>14} {4:>9} {5:>13} {6:>15}'.format(
+        'rigs', 'wall s', 'CPU ms/frame', 'idle MB/rig', 'RSS MB', 'peak RSS MB', 'added MB/rig'))
+    first = None
+    for rigs in rig_counts:
+        output = subprocess.run(
+            [sys.executable, __file__, '--child', str(rigs), str(frames), str(width), str(height)],
+            check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        first = first or result
+        # Peak memory for each rig beyond the first run's.
+        added = (result['peak_rss_mb'] - first['peak_rss_mb']) / (rigs - first['rigs']) if rigs > first['rigs'] else float('nan')
+        print('{rigs:>5} {wall_s:>9.2f} {0:>12.1f} {idle_mb_per_rig:>14.2f} {rss_mb:>9.0f} {peak_rss_mb:>13.0f} {1:>15.1f}'.format(
+            result['cpu_s'] * 1000 / result['frames'], added, **result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+""" Benchmark MQTT publish throughput and latency.
+
+Compares the previous setup (paho's loop_start() thread, publishing from the
+asyncio loop) with AsyncMqttClient. Latency is publish call to PUBACK.
+
+Usage: python benchmarks/mqtt_publish.py <mqtt host> [port] [messages] [qos]
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import paho.mqtt.client as mqtt
+
+from mqtt_client import AsyncMqttClient
+
+TOPIC = 'astro_mqtt_benchmark/{0}/state'
+PAYLOAD = '12.345'
+
+
+def report(name, started, finished, latencies):
+    elapsed = finished - started
+    latencies = sorted(latencies)
+    print('{0:<12} {1:>8.0f} msg/s   p50 {2:>7.2f} ms   p99 {3:>7.2f} ms'.format(
+        name,
+        len(latencies) / elapsed,
+        statistics.median(latencies) * 1000,
+        latencies[int(len(latencies) * 0.99) - 1] * 1000))
+
+
+async def bench_threaded(host, port, messages, qos):
+    sent = {}
+    acked = {}
+    done = threading.Event()
+
+    def on_publish(client, userdata, mid, reason_code, properties):
+        acked[mid] = time.perf_counter()
+        if len(acked) == messages:
+            done.set()
+
+    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+    client.on_publish = on_publish
+    client.connect(host, port, 60)
+    client.loop_start()
+    await asyncio.sleep(1)
+
+    started = time.perf_counter()
+    for i in range(messages):
+        now = time.perf_counter()
+        info = client.publish(TOPIC.format(i % 50), PAYLOAD, qos=qos)
+        sent[info.mid] = now
+    await asyncio.get_running_loop().run_in_executor(None, done.wait)
+    finished = time.perf_counter()
+    client.loop_stop()
+    client.disconnect()
+    report('paho thread', started, finished, [acked[mid] - sent[mid] for mid in sent])
+
+
+async def bench_async(host, port, messages, qos):
+    client = AsyncMqttClient()
+    await client.connect(host, port)
+    latencies = []
+
+    async def publish(i):
+        start = time.perf_counter()
+        await client.publish(TOPIC.format(i % 50), PAYLOAD, qos=qos, wait=True)
+        latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[publish(i) for i in range(messages)])
+    finished = time.perf_counter()
+    await client.disconnect()
+    report('asyncio', started, finished, latencies)
+
+
+async def main():
+    host = sys.argv[1]
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 1883
+    messages = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+    qos = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    print('{0} messages, qos {1}'.format(messages, qos))
+    await bench_threaded(host, port, messages, qos)
+    await bench_async(host, port, messages, qos)
+
+if __name__ == '__main__':
+    asyncio.run(main())
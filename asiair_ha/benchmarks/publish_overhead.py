@@ -0,0 +1,70 @@
+""" Micro-benchmark of the per-publish bookkeeping overhead.
+
+"before" re-implements the old path: walking dir(device) for the component
+list on every poll and building each state topic by concatenation on every
+publish. "after" uses the precomputed component table and topic map.
+Device RPCs and the MQTT client are left out; only the bridge's own
+overhead is measured.
+
+Usage: python benchmarks/publish_overhead.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from asiair import ZwoAsiair
+
+
+def components_before(device):
+    components = []
+    for attr_name in dir(device):
+        method = getattr(device, attr_name)
+        if hasattr(method, 'component_config'):
+            components.append(method)
+    return components
+
+
+def topic_before(device_root_topic, mqtt_component, topic):
+    return device_root_topic + '/' + mqtt_component.component_id + ('' if topic == '' else '/' + topic )
+
+
+def topic_after(state_topics, mqtt_component, topic):
+    return state_topics[(mqtt_component.component_id, topic)]
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    asiair = ZwoAsiair('bench', address='localhost')
+    devices = list(asiair.devices.values())
+    for device in devices:
+        device.bind_topics('asiair/' + device.name)
+    publishes = [
+        (device, component, topic)
+        for device in devices
+        for component in device.components()
+        for topic in component.subscription_topic_map.keys()
+    ]
+
+    def poll_before():
+        for device in devices:
+            for component in components_before(device):
+                for topic in component.subscription_topic_map.keys():
+                    topic_before('asiair/' + device.name, component, topic)
+
+    def poll_after():
+        for device in devices:
+            for component in device.components():
+                for topic in component.subscription_topic_map.keys():
+                    topic_after(device.state_topics, component, topic)
+
+    print('{0} publishes per poll of every component'.format(len(publishes)))
+    for name, fn in [('before', poll_before), ('after', poll_after)]:
+        seconds = timeit.timeit(fn, number=iterations) / iterations
+        print('{0:<8} {1:>8.1f} us per poll  {2:>6.2f} us per publish'.format(
+            name, seconds * 1e6, seconds * 1e6 / len(publishes)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+""" Master dark and flat frames, built from calibration frames and cached on disk. """
+
+from collections import namedtuple
+import logging
+import os
+import re
+
+import numpy as np
+
+from const import (
+    CALIBRATION_CACHE_DIR,
+    CALIBRATION_MAX_FRAMES,
+    CALIBRATION_MIN_FRAMES,
+    CALIBRATION_TEMPERATURE_BAND,
+)
+
+FRAME_TYPE_LIGHT = 'light'
+FRAME_TYPE_DARK = 'dark'
+FRAME_TYPE_FLAT = 'flat'
+
+CalibrationKey = namedtuple('CalibrationKey', ['camera', 'gain', 'exposure', 'binning', 'temperature_band'])
+
+
+def temperature_band(temperature):
+    if temperature is None:
+        return None
+    return int(round(temperature / CALIBRATION_TEMPERATURE_BAND) * CALIBRATION_TEMPERATURE_BAND)
+
+
+class CalibrationLibrary:
+    """ Binned master darks and flats, stored as .npy files and memory-mapped.
+
+    Masters are the running mean of the calibration frames seen for a key,
+    and are written once CALIBRATION_MIN_FRAMES have been seen. Darks match on
+    the whole key; flats only on camera, gain and binning, and are stored
+    normalised to a median of 1.
+    """
+    def __init__(self, directory=CALIBRATION_CACHE_DIR):
+        self.directory = os.path.expanduser(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.masters = {}
+        self.building = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key_for(frame_type: str, key: CalibrationKey):
+        if frame_type == FRAME_TYPE_FLAT:
+            return key._replace(exposure=None, temperature_band=None)
+        return key
+
+    def _path(self, frame_type: str, key: CalibrationKey):
+        name = '{0}_{1}_g{2}_e{3}_b{4}_t{5}.npy'.format(frame_type, *key)
+        return os.path.join(self.directory, re.sub(r'[^\w.\-]', '_', name))
+
+    def master(self, frame_type: str, key: CalibrationKey):
+        """ The memory-mapped master for key, or None if there isn't one yet. """
+        path = self._path(frame_type, self._key_for(frame_type, key))
+        master = self.masters.get(path)
+        if master is None and os.path.exists(path):
+            master = np.load(path, mmap_mode='r')
+            self.masters[path] = master
+        if master is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return master
+
+    def add(self, frame_type: str, key: CalibrationKey, frame):
+        """ Add a binned calibration frame to the master being built for key. """
+        path = self._path(frame_type, self._key_for(frame_type, key))
+        (accumulator, count) = self.building.get(path, (None, 0))
+        if count >= CALIBRATION_MAX_FRAMES:
+            return
+        if accumulator is None or accumulator.shape != frame.shape:
+            (accumulator, count) = (np.zeros(frame.shape, dtype=np.float32), 0)
+
+        if frame_type == FRAME_TYPE_FLAT:
+            self.apply_dark(key, frame)
+            frame = frame / np.median(frame)
+        count += 1
+        accumulator += (frame - accumulator) / count
+        self.building[path] = (accumulator, count)
+        logging.info('Calibration %s: %d frames for %s', frame_type, count, key)
+
+        if count >= CALIBRATION_MIN_FRAMES:
+            self._write(path, accumulator)
+
+    def _write(self, path: str, accumulator):
+        partial = path + '.partial'
+        master = np.lib.format.open_memmap(partial, mode='w+', dtype=np.float32, shape=accumulator.shape)
+        master[:] = accumulator
+        master.flush()
+        del master
+        os.replace(partial, path)
+        # Re-map on next use.
+        self.masters.pop(path, None)
+
+    def apply_dark(self, key: CalibrationKey, frame):
+        dark = self.master(FRAME_TYPE_DARK, key)
+        if dark is not None and dark.shape == frame.shape:
+            np.subtract(frame, dark, out=frame)
+            np.maximum(frame, 0, out=frame)
+
+    def apply(self, key: CalibrationKey, frame):
+        """ Dark subtract and flat divide a binned float32 frame, in place. """
+        self.apply_dark(key, frame)
+        flat = self.master(FRAME_TYPE_FLAT, key)
+        if flat is not None and flat.shape == frame.shape:
+            np.divide(frame, flat, out=frame, where=flat > 0)
@@ -0,0 +1,158 @@
+""" Routes MQTT commands to devices, with a worker per device. """
+
+import asyncio
+from collections import OrderedDict
+import json
+import logging
+import time
+
+from const import COMMAND_CONFIRM_DELAY_SECONDS, COMMAND_DEBOUNCE_SECONDS, COMMAND_OPTIMISTIC
+
+
+class CommandStats:
+    def __init__(self):
+        self.received = 0
+        self.coalesced = 0
+        self.completed = 0
+        self.failed = 0
+        self.rolled_back = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def mean_latency(self):
+        handled = self.completed + self.failed
+        return self.total_latency / handled if handled else 0.0
+
+
+class DeviceQueue:
+    """ Commands waiting for one device, at most one per command topic. """
+    def __init__(self, device):
+        self.device = device
+        self.pending = OrderedDict()
+        # The read-back confirmation task for the last command to each topic.
+        self.confirms = {}
+        self.ready = asyncio.Event()
+        self.stats = CommandStats()
+        self.worker = None
+
+
+def same_value(a, b):
+    """ Compare two payloads as JSON values where possible, so that 5 and 5.0 match. """
+    def parse(payload):
+        try:
+            return json.loads(payload)
+        except (TypeError, ValueError):
+            return payload
+    return parse(a) == parse(b)
+
+
+class CommandRouter:
+    """ Runs commands in the order they arrived for each device, and devices in parallel.
+
+    A command that arrives while an earlier one for the same topic is still
+    waiting replaces it, so a burst from a slider only sends the final value.
+    Workers wait debounce seconds after being woken to let bursts settle.
+
+    If the command has a matching state topic, the value the command returns
+    is published to it. With optimistic set, the commanded value is published
+    straight away instead, and confirm_delay seconds after the command that
+    state is read back from the device and published. If it disagrees with
+    what was commanded, a warning is logged and the entity rolls back to the
+    device's value.
+    """
+    def __init__(self, debounce=COMMAND_DEBOUNCE_SECONDS, optimistic=COMMAND_OPTIMISTIC, confirm_delay=COMMAND_CONFIRM_DELAY_SECONDS):
+        self.debounce = debounce
+        self.optimistic = optimistic
+        self.confirm_delay = confirm_delay
+        self.queues = {}
+
+    def submit(self, device, component, topic: str, fn, payload, state_topic=None):
+        """ Queue a command. Must be called from the event loop.
+
+        state_topic is the component's state topic that reflects the command, if any.
+        """
+        queue = self.queues.get(id(device))
+        if queue is None:
+            queue = DeviceQueue(device)
+            self.queues[id(device)] = queue
+        if queue.worker is None:
+            queue.worker = asyncio.get_running_loop().create_task(self._work(queue))
+
+        queue.stats.received += 1
+        confirm = queue.confirms.pop(topic, None)
+        if confirm is not None:
+            # Superseded; the new command will be confirmed instead.
+            confirm.cancel()
+        if topic in queue.pending:
+            queue.stats.coalesced += 1
+        # Assigning to an existing key keeps its place, so the replacement runs in the original's turn.
+        queue.pending[topic] = (component, fn, payload, state_topic, time.monotonic())
+        queue.ready.set()
+
+    def stats(self):
+        """ {device root topic: (queue depth, CommandStats)} """
+        return {
+            queue.device.root_topic: (len(queue.pending), queue.stats)
+            for queue in self.queues.values()
+        }
+
+    async def _work(self, queue: DeviceQueue):
+        while True:
+            await queue.ready.wait()
+            if self.debounce:
+                await asyncio.sleep(self.debounce)
+            queue.ready.clear()
+            while queue.pending:
+                (topic, (component, fn, payload, state_topic, received_at)) = queue.pending.popitem(last=False)
+                await self._execute(queue, component, topic, fn, payload, state_topic)
+                latency = time.monotonic() - received_at
+                queue.stats.total_latency += latency
+                queue.stats.max_latency = max(queue.stats.max_latency, latency)
+
+    async def _execute(self, queue: DeviceQueue, component, topic: str, fn, payload, state_topic):
+        device = queue.device
+        expected = payload.decode()
+        if self.optimistic and state_topic is not None:
+            await device.on_publish(component, state_topic, expected)
+        try:
+            value = json.loads(payload)
+        except json.JSONDecodeError:
+            value = expected # just use the string
+        try:
+            new_value = await fn(device, value)
+            queue.stats.completed += 1
+            if new_value is not None and not self.optimistic and state_topic is not None:
+                expected = new_value if isinstance(new_value, str) else json.dumps(new_value)
+                await device.on_publish(component, state_topic, expected)
+        except NotImplementedError:
+            queue.stats.failed += 1
+            logging.error('Not implemented - command for "%s"', topic)
+        except Exception as ex:
+            queue.stats.failed += 1
+            logging.error('Command for "%s" failed: %s', topic, ex)
+        if self.optimistic and state_topic is not None:
+            confirm = asyncio.get_running_loop().create_task(
+                self._confirm(queue, component, state_topic, expected))
+            queue.confirms[topic] = confirm
+
+            def forget(task):
+                if queue.confirms.get(topic) is task:
+                    del queue.confirms[topic]
+            confirm.add_done_callback(forget)
+
+    async def _confirm(self, queue: DeviceQueue, component, state_topic: str, expected):
+        await asyncio.sleep(self.confirm_delay)
+        device = queue.device
+        try:
+            actual = await component.subscription_topic_map[state_topic](device)
+        except Exception as ex:
+            logging.error('Reading back "%s" failed: %s', state_topic, ex)
+            return
+        if actual is None:
+            return
+        if not isinstance(actual, (str, bytes, bytearray)):
+            actual = json.dumps(actual)
+        if not same_value(actual, expected):
+            queue.stats.rolled_back += 1
+            logging.warning('%s %s is %s after a command for %s', device.root_topic, component.component_id, actual, expected)
+        await device.on_publish(component, state_topic, actual)
@@ -31,6 +31,148 @@ STRETCH_AP_STRETCH_FUNCTION = "asinh"
 STRETCH_AP_MINMAX_PERCENT = [15, 95]  # [0.5, 95]
 STRETCH_AP_MINMAX_VALUE = None
 
+# Image Fetching
+# Valid Options: always (download every frame), demand (only while a
+# consumer has asked for images within IMAGE_DEMAND_WINDOW_SECONDS)
+IMAGE_FETCH_ALWAYS = "always"
+IMAGE_FETCH_DEMAND = "demand"
+IMAGE_FETCH_MODE = IMAGE_FETCH_ALWAYS
+IMAGE_DEMAND_WINDOW_SECONDS = 300
+IMAGE_CHANNEL_RECONNECT_MAX_SECONDS = 60
+
+# Frame History & Time-lapse
+FRAME_HISTORY_MAX_FRAMES = 120
+FRAME_HISTORY_MAX_BYTES = 128 * 1024 * 1024
+TIMELAPSE_DIMENSIONS = (960, 540)
+TIMELAPSE_FRAME_DURATION_MS = 250
+TIMELAPSE_WEBP_QUALITY = 60
+
+# Live Stacking
+LIVE_STACK_ENABLED = True
+STACK_MIN_CORRELATION = 0.02
+STACK_MAX_SHIFT_FRACTION = 0.25
+
+# Calibration
+CALIBRATION_CACHE_DIR = "~/.cache/astro_mqtt/calibration"
+CALIBRATION_TEMPERATURE_BAND = 5
+CALIBRATION_MIN_FRAMES = 5
+CALIBRATION_MAX_FRAMES = 50
+# Masters are only built if this names the Exposure event field that tags a
+# frame as dark or flat. No capture has shown the ASIAIR sending one yet, so
+# by default every frame is treated as a light.
+CALIBRATION_FRAME_TYPE_FIELD = None
+
+# Threads for image processing, shared by all connections.
+IMAGE_WORKER_THREADS = 2
+
+# Deep Zoom Tiles (keeps the latest full resolution frame in memory)
+TILE_PYRAMID_ENABLED = False
+TILE_SIZE = 256
+TILE_CACHE_MAX_TILES = 1024
+TILE_JPEG_QUALITY = 85
+
+# #########################################################################
+# HTTP Server
+# #########################################################################
+HTTP_SERVER_HOST = "0.0.0.0"
+HTTP_SERVER_PORT = 8480
+
+# #########################################################################
+# MQTT Publishing
+# #########################################################################
+# Unchanged values are re-sent at least this often.
+PUBLISH_REFRESH_SECONDS = 600
+PUBLISH_STATS_INTERVAL_SECONDS = 300
+
+# Publish each device's state as one JSON document on {connection}/{device}/document,
+# with discovery templates picking the values out, instead of a topic per value.
+STATE_DOCUMENT_ENABLED = False
+STATE_DOCUMENT_FLUSH_SECONDS = 1
+
+MQTT_KEEPALIVE_SECONDS = 60
+MQTT_CONNECT_TIMEOUT_SECONDS = 30
+MQTT_RECONNECT_MAX_SECONDS = 60
+# Maximum qos > 0 publishes awaiting a PUBACK before publishers wait.
+MQTT_MAX_INFLIGHT = 20
+# While the broker is unreachable, the latest message per topic is kept, within
+# these limits. Set a spill path to write the overflow to disk instead of dropping it.
+MQTT_BUFFER_MAX_TOPICS = 2000
+MQTT_BUFFER_MAX_BYTES = 16 * 1024 * 1024
+MQTT_BUFFER_SPILL_PATH = None
+# Buffered messages are re-sent in batches of this size, this far apart.
+MQTT_BUFFER_FLUSH_BATCH = 50
+MQTT_BUFFER_FLUSH_INTERVAL_SECONDS = 0.1
+
+# Device discovery configs go to {DISCOVERY_TOPIC_ROOT}/{DISCOVERY_OBJECT_ID_PREFIX}_{connection}_{device}/config.
+# HA only reads <prefix>/<component>/[<node_id>/]<object_id>/config, so there
+# is no room for another level. Older versions used the node id astro_mqtt.
+DISCOVERY_TOPIC_ROOT = "homeassistant/device"
+DISCOVERY_OBJECT_ID_PREFIX = "astro_mqtt"
+# How long to collect the configs already retained on the broker at startup.
+DISCOVERY_RETAINED_WAIT_SECONDS = 2
+
+# Home Assistant's birth and last will topic. When HA comes back online, the
+# last discovery and state messages are re-sent from memory, paced.
+HA_STATUS_TOPIC = "homeassistant/status"
+HA_STATUS_ONLINE = "online"
+REPUBLISH_BATCH = 50
+REPUBLISH_INTERVAL_SECONDS = 0.1
+REPUBLISH_SETTLE_SECONDS = 2
+
+# Bridge and per-device availability, as retained online/offline messages.
+BRIDGE_STATUS_TOPIC = "astro_mqtt/status"
+PAYLOAD_AVAILABLE = "online"
+PAYLOAD_NOT_AVAILABLE = "offline"
+
+# #########################################################################
+# Connections
+# #########################################################################
+CONNECT_TIMEOUT_SECONDS = 10
+DISCOVER_TIMEOUT_SECONDS = 20
+# Unreachable software is retried in the background, backing off up to this.
+CONNECT_RETRY_MAX_SECONDS = 300
+
+# ASIAIR protocol captures: zlib image data (already zipped by the ASIAIR, so
+# this gains little), and how often to flush the capture file.
+CAPTURE_COMPRESS_IMAGES = False
+CAPTURE_FLUSH_SECONDS = 1
+
+# #########################################################################
+# Events
+# #########################################################################
+EVENT_AGGREGATE_LAST = "last"
+EVENT_AGGREGATE_MEAN = "mean"
+EVENT_AGGREGATE_MAX = "max"
+# ASIAIR events to rate limit: event -> (min interval seconds, fields to
+# aggregate over the interval, aggregate). Other events are handled as they come.
+EVENT_AGGREGATION = {
+    "Temperature": (10, ("value",), EVENT_AGGREGATE_MEAN),
+    "CoolerPower": (10, ("value",), EVENT_AGGREGATE_LAST),
+    "PiStatus": (10, (), EVENT_AGGREGATE_LAST),
+}
+
+# #########################################################################
+# Commands
+# #########################################################################
+# Commands wait this long so that bursts to one topic collapse to the last value.
+COMMAND_DEBOUNCE_SECONDS = 0.2
+# Optionally publish the commanded state straight away, then read it back from
+# the device this long after the command, rolling back if the device disagrees.
+COMMAND_OPTIMISTIC = False
+COMMAND_CONFIRM_DELAY_SECONDS = 2
+
+# #########################################################################
+# Polling
+# #########################################################################
+# Special poll intervals, for components that don't poll on a timer.
+POLL_ONCE = "once"
+POLL_EVENTS_ONLY = "events"
+POLL_JITTER_FRACTION = 0.1
+POLL_STARTUP_SPREAD_SECONDS = 10
+# Default concurrent component refreshes per connection, and how long each may take.
+POLL_CONCURRENCY = 4
+POLL_TIMEOUT_SECONDS = 15
+
 # #########################################################################
 # Devices
 # #########################################################################
@@ -73,6 +215,7 @@ STATE_ON = "on"
 STATE_OFF = "off"
 
 TYPE_BINARY_SENSOR = "binary_sensor"
+TYPE_BUTTON = "button"
 TYPE_SENSOR = "sensor"
 TYPE_SWITCH = "switch"
 TYPE_TEXT = "text"
@@ -81,6 +224,20 @@ TYPE_CLIMATE = "climate"
 TYPE_DEVICE_TRACKER = "device_tracker"
 TYPE_NUMBER = "number"
 
+# Default (qos, retain, min_interval seconds) of state publishes by platform.
+# Telemetry goes at qos 0. State that HA can set is retained, so HA has it as
+# soon as it restarts. Other platforms use PUBLISH_POLICY_DEFAULT.
+PUBLISH_POLICY_DEFAULT = (0, False, None)
+PUBLISH_POLICIES = {
+    TYPE_BINARY_SENSOR: (0, True, None),
+    TYPE_SWITCH: (1, True, None),
+    TYPE_NUMBER: (1, True, None),
+    TYPE_TEXT: (1, True, None),
+    TYPE_CLIMATE: (1, True, None),
+    TYPE_DEVICE_TRACKER: (0, True, None),
+    TYPE_CAMERA: (0, False, 2),
+}
+
 UNIT_OF_MEASUREMENT_NONE = None
 UNIT_OF_MEASUREMENT_ARCSEC_PER_SEC = '"/s'
 UNIT_OF_MEASUREMENT_DEGREE = "°"
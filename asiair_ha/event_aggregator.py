@@ -0,0 +1,95 @@
+""" Rate limiting and windowed aggregation of push events. """
+
+import asyncio
+import logging
+import time
+
+from const import EVENT_AGGREGATE_LAST, EVENT_AGGREGATE_MAX, EVENT_AGGREGATE_MEAN
+
+AGGREGATES = {
+    EVENT_AGGREGATE_LAST: lambda values: values[-1],
+    EVENT_AGGREGATE_MEAN: lambda values: sum(values) / len(values),
+    EVENT_AGGREGATE_MAX: max,
+}
+
+
+class EventWindow:
+    def __init__(self):
+        self.sent_at = None
+        self.payload = None
+        self.values = {}
+        self.timer = None
+        self.received = 0
+        self.delivered = 0
+
+
+class EventAggregator:
+    """ Sits between an event source and its handler.
+
+    rules maps an event name to (min_interval, fields, aggregate). The first
+    event of a type is handled straight away. Events that arrive within
+    min_interval of the last one handled are held, and when the interval is
+    up the latest of them is handled, with each of its fields replaced by the
+    aggregate (last, mean or max) of that field over the window. Events
+    without a rule are handled straight away.
+    """
+    def __init__(self, rules: dict, handler):
+        self.rules = rules
+        self.handler = handler
+        self.windows = {}
+
+    async def put(self, event: str, payload):
+        rule = self.rules.get(event)
+        if rule is None or not isinstance(payload, dict):
+            await self.handler(event, payload)
+            return
+
+        (min_interval, fields, _) = rule
+        window = self.windows.setdefault(event, EventWindow())
+        window.received += 1
+        now = time.monotonic()
+        if window.timer is None and (window.sent_at is None or now - window.sent_at >= min_interval):
+            window.sent_at = now
+            window.delivered += 1
+            await self.handler(event, payload)
+            return
+
+        window.payload = payload
+        for field in fields:
+            value = payload.get(field)
+            if isinstance(value, (int, float)):
+                window.values.setdefault(field, []).append(value)
+        if window.timer is None:
+            delay = window.sent_at + min_interval - now
+            window.timer = asyncio.get_running_loop().create_task(self._flush(event, window, delay))
+
+    async def _flush(self, event: str, window: EventWindow, delay: float):
+        await asyncio.sleep(delay)
+        (_, _, aggregate) = self.rules[event]
+        payload = dict(window.payload)
+        for (field, values) in window.values.items():
+            payload[field] = AGGREGATES[aggregate](values)
+        window.payload = None
+        window.values = {}
+        window.timer = None
+        window.sent_at = time.monotonic()
+        window.delivered += 1
+        try:
+            await self.handler(event, payload)
+        except Exception as ex:
+            logging.error('Handling aggregated %s event failed: %s', event, ex)
+
+    async def close(self):
+        """ Cancel the timers of held events, and wait for them to stop. Held events are dropped. """
+        timers = [window.timer for window in self.windows.values() if window.timer is not None]
+        for timer in timers:
+            timer.cancel()
+        await asyncio.gather(*timers, return_exceptions=True)
+        for window in self.windows.values():
+            window.timer = None
+            window.payload = None
+            window.values = {}
+
+    def stats(self):
+        """ {event: (received, delivered)} for events with a rule. """
+        return {event: (window.received, window.delivered) for (event, window) in self.windows.items()}
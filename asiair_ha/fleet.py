@@ -0,0 +1,75 @@
+""" Connections to run, from a JSON config file or the legacy command line.
+
+A config file lists any number of connections, keyed by the name used in
+their MQTT topics and HTTP paths:
+
+    {
+        "mqtt": {"host": "homeassistant.local", "port": 1883, "username": "astro", "password": "..."},
+        "connections": {
+            "asiair": {"type": "asiair", "name": "ASIAIR", "address": "asiair.local"},
+            "asiair2": {"type": "asiair", "name": "ASIAIR 2", "address": "192.168.1.51", "image_mode": "demand"},
+            "nina": {"type": "nina", "name": "NINA", "host": "astrobee"},
+            "stellarium": {"type": "stellarium", "name": "Stellarium Mac", "host": "MacStudio"}
+        }
+    }
+
+Any other keys of a connection are passed to its create(). For example, an
+ASIAIR connection with "capture": "night.cap" records its traffic to that
+file, and one with "replay": "night.cap" (and optionally "replay_realtime":
+false) plays it back in place of the ASIAIR; see protocol_capture.py. Setting
+"frame_type_field" turns on building calibration masters from dark and flat
+frames; see CALIBRATION_FRAME_TYPE_FIELD.
+"""
+
+import json
+import re
+
+from asiair import ZwoAsiair
+from nina import Nina
+from stellarium import Stellarium
+
+CONNECTION_TYPES = {
+    'asiair': ZwoAsiair,
+    'nina': Nina,
+    'stellarium': Stellarium,
+}
+
+
+def legacy_config(asiair_host, mqtt_host, mqtt_port, mqtt_username, mqtt_password):
+    """ The single rig setup of the original command line. """
+    return {
+        'mqtt': {
+            'host': mqtt_host,
+            'port': int(mqtt_port),
+            'username': mqtt_username,
+            'password': mqtt_password,
+        },
+        'connections': {
+            'asiair': {'type': 'asiair', 'name': 'ASIAIR', 'address': asiair_host},
+            'nina': {'type': 'nina', 'name': 'NINA', 'host': 'astrobee'},
+            'stellarium': {'type': 'stellarium', 'name': 'Stellarium Mac', 'host': 'MacStudio'},
+            'planetarium': {'type': 'stellarium', 'name': 'Planetarium', 'host': 'ObservatoryMiniPC'},
+        },
+    }
+
+
+def load_config(path: str):
+    with open(path) as config_file:
+        config = json.load(config_file)
+    config['mqtt'].setdefault('port', 1883)
+    return config
+
+
+def create_connections(config: dict):
+    """ {connection name: ObservatorySoftware} for the connections in config. """
+    connections = {}
+    for (cnx_name, options) in config['connections'].items():
+        if not re.fullmatch(r'[A-Za-z0-9_\-]+', cnx_name):
+            raise ValueError('Connection name "{0}" must only use letters, digits, _ and -'.format(cnx_name))
+        options = dict(options)
+        cnx_type = options.pop('type')
+        if cnx_type not in CONNECTION_TYPES:
+            raise ValueError('Unknown type "{0}" for connection "{1}"'.format(cnx_type, cnx_name))
+        name = options.pop('name', cnx_name)
+        connections[cnx_name] = CONNECTION_TYPES[cnx_type].create(name, **options)
+    return connections
@@ -0,0 +1,132 @@
+""" In-memory history of recent previews and a rolling animated WebP time-lapse. """
+
+from collections import OrderedDict, namedtuple
+import logging
+import struct
+import time
+
+import cv2
+
+from const import (
+    FRAME_HISTORY_MAX_BYTES,
+    FRAME_HISTORY_MAX_FRAMES,
+    TIMELAPSE_DIMENSIONS,
+    TIMELAPSE_FRAME_DURATION_MS,
+    TIMELAPSE_WEBP_QUALITY,
+)
+
+Frame = namedtuple('Frame', ['id', 'timestamp', 'png', 'anmf', 'width', 'height'])
+
+# Chunks from a still WebP that make up the frame data of an ANMF chunk.
+WEBP_FRAME_CHUNKS = (b'ALPH', b'VP8 ', b'VP8L')
+
+
+def _riff_chunk(fourcc: bytes, payload: bytes):
+    chunk = fourcc + struct.pack('<I', len(payload)) + payload
+    if len(payload) % 2:
+        chunk += b'\x00'
+    return chunk
+
+
+def _uint24(value: int):
+    return struct.pack('<I', value)[:3]
+
+
+def webp_frame_data(webp: bytes):
+    """ Extract the (ALPH +) VP8/VP8L chunks from a still WebP file. """
+    if webp[:4] != b'RIFF' or webp[8:12] != b'WEBP':
+        raise ValueError('Not a WebP image')
+    data = b''
+    offset = 12
+    while offset + 8 <= len(webp):
+        fourcc = webp[offset:offset + 4]
+        (size,) = struct.unpack('<I', webp[offset + 4:offset + 8])
+        end = offset + 8 + size + (size % 2)
+        if fourcc in WEBP_FRAME_CHUNKS:
+            data += webp[offset:end]
+        offset = end
+    return data
+
+
+class FrameHistory:
+    """ The last max_frames previews, evicted oldest first to stay within max_bytes.
+
+    Each frame is WebP encoded once, when it is added, and kept as a ready-made
+    ANMF chunk. The time-lapse is then just a header followed by the chunks of
+    the frames still in the history, so no frame is ever re-encoded.
+    The newest frame is always kept, even if it alone is over budget.
+    """
+    def __init__(
+            self,
+            max_frames=FRAME_HISTORY_MAX_FRAMES,
+            max_bytes=FRAME_HISTORY_MAX_BYTES,
+            frame_duration_ms=TIMELAPSE_FRAME_DURATION_MS):
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.frame_duration_ms = frame_duration_ms
+        self.frames = OrderedDict()
+        self.bytes = 0
+        self.next_id = 1
+        self._timelapse = None
+
+    def add(self, preview, png: bytes):
+        """ Add a uint8 preview image and its PNG encoding. Returns the new Frame. """
+        h, w = preview.shape[:2]
+        target_w, target_h = TIMELAPSE_DIMENSIONS
+        scale = min(1, target_w / w, target_h / h)
+        if scale < 1:
+            preview = cv2.resize(preview, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+        (_, webp) = cv2.imencode('.webp', preview, [cv2.IMWRITE_WEBP_QUALITY, TIMELAPSE_WEBP_QUALITY])
+        height, width = preview.shape[:2]
+        anmf = _riff_chunk(
+            b'ANMF',
+            _uint24(0) + _uint24(0)
+            + _uint24(width - 1) + _uint24(height - 1)
+            + _uint24(self.frame_duration_ms)
+            + b'\x02' # Don't blend with the previous frame.
+            + webp_frame_data(webp.tobytes()))
+
+        frame = Frame(self.next_id, time.time(), bytes(png), anmf, width, height)
+        self.next_id += 1
+        self.frames[frame.id] = frame
+        self.bytes += self._size(frame)
+        self._timelapse = None
+        while len(self.frames) > 1 and (len(self.frames) > self.max_frames or self.bytes > self.max_bytes):
+            (_, evicted) = self.frames.popitem(last=False)
+            self.bytes -= self._size(evicted)
+        logging.debug('Frame history: %d frames, %d bytes', len(self.frames), self.bytes)
+        return frame
+
+    @staticmethod
+    def _size(frame: Frame):
+        return len(frame.png) + len(frame.anmf)
+
+    def get(self, id: int):
+        return self.frames.get(id)
+
+    def latest(self):
+        if not self.frames:
+            return None
+        return next(reversed(self.frames.values()))
+
+    def gallery(self):
+        return [
+            {'id': frame.id, 'timestamp': frame.timestamp, 'bytes': len(frame.png)}
+            for frame in self.frames.values()
+        ]
+
+    def timelapse(self):
+        """ An animated WebP of every frame in the history, or None if it is empty. """
+        if not self.frames:
+            return None
+        if self._timelapse is None:
+            canvas_w = max(frame.width for frame in self.frames.values())
+            canvas_h = max(frame.height for frame in self.frames.values())
+            vp8x = _riff_chunk(
+                b'VP8X',
+                b'\x02\x00\x00\x00' # Animation flag.
+                + _uint24(canvas_w - 1) + _uint24(canvas_h - 1))
+            anim = _riff_chunk(b'ANIM', struct.pack('<IH', 0xff000000, 0))
+            body = b''.join([b'WEBP', vp8x, anim] + [frame.anmf for frame in self.frames.values()])
+            self._timelapse = b'RIFF' + struct.pack('<I', len(body)) + body
+        return self._timelapse
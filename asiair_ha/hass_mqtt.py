@@ -1,56 +1,313 @@
 '''Decorators to enable '''
 
 import asyncio
+from collections import namedtuple
 from functools import partial
+import hashlib
 import json
 import logging
 import sys
-from const import DEVICE_CLASS_SWITCH, STATE_CLASS_NONE, TYPE_BINARY_SENSOR, TYPE_CAMERA, TYPE_CLIMATE, TYPE_DEVICE_TRACKER, TYPE_NUMBER, TYPE_SENSOR, TYPE_SWITCH, TYPE_TEXT, UNIT_OF_MEASUREMENT_NONE
+import time
+from const import DEVICE_CLASS_SWITCH, POLL_EVENTS_ONLY, PUBLISH_POLICIES, PUBLISH_POLICY_DEFAULT, PUBLISH_REFRESH_SECONDS, REPUBLISH_BATCH, REPUBLISH_INTERVAL_SECONDS, REPUBLISH_SETTLE_SECONDS, STATE_CLASS_NONE, STATE_DOCUMENT_FLUSH_SECONDS, TYPE_BINARY_SENSOR, TYPE_BUTTON, TYPE_CAMERA, TYPE_CLIMATE, TYPE_DEVICE_TRACKER, TYPE_NUMBER, TYPE_SENSOR, TYPE_SWITCH, TYPE_TEXT, UNIT_OF_MEASUREMENT_NONE
 
 def mqtt_device(**kwargs):
     def _mqtt_device(cls):
         return MqttDevice(cls, **kwargs)
     return _mqtt_device
 
+# A state or command topic of a component. suffix is the topic relative to
+# the device's root topic, and config_key its key in the discovery config.
+TopicSpec = namedtuple('TopicSpec', ['topic', 'config_key', 'suffix', 'fn'])
+ComponentSpec = namedtuple('ComponentSpec', ['component_id', 'component', 'state_topics', 'command_topics'])
+
+def build_component_table(cls):
+    '''Find the components of a class and precompute their topics.'''
+    table = []
+    for attr_name in dir(cls):
+        component = getattr(cls, attr_name)
+        if not hasattr(component, 'component_config'):
+            continue
+        component_id = component.component_id
+        state_topics = tuple(
+            TopicSpec(
+                topic,
+                'topic' if topic == '' else topic + '_topic',
+                '/' + component_id + ('' if topic == '' else '/' + topic),
+                fn)
+            for topic, fn in component.subscription_topic_map.items())
+        command_topics = tuple(
+            TopicSpec(topic, topic + '_topic', '/' + component_id + '/' + topic, fn)
+            for topic, fn in component.command_topic_map.items())
+        table.append(ComponentSpec(component_id, component, state_topics, command_topics))
+    return tuple(table)
+
 class MqttDevice():
-    '''Class decorator for a device that will be published via MQTT'''
+    '''Class decorator for a device that will be published via MQTT
+
+    The component table is built once, here, rather than each time the
+    device's components are needed.'''
     def __init__(self, cls, **kwargs):
         self.cls = cls
         print('Init MqttDevice for ' + cls.__name__)
 
-    def __call__(self, *args, **kwargs):
-        cls = self.cls
-        print('Created MqttDevice for ', cls.__name__)
-        #sys.exit(0)
+        cls.component_table = build_component_table(cls)
+        cls.mqtt_components = tuple(spec.component for spec in cls.component_table)
+        logging.info('Class %s has %d components', cls.__name__, len(cls.mqtt_components))
 
-        components = []
-        for attr_name in dir(cls):
-            method = getattr(cls, attr_name)
-            if hasattr(method, 'component_config'):
-                components.append(method)
-        cls.mqtt_components = components
-        logging.info('Class %s has %d components', cls.__name__, len(components))
+        async def on_publish(self, mqtt_component, topic, payload):
+            logging.warning('No on_publish set for class %s', cls.__name__)
 
+        def bind_topics(self, root_topic: str, command_root_topic=None):
+            '''Set the root topics for this device and format the full topic of every component.
 
-        def on_publish(self, mqtt_component, payload):
-            logging.warning('No on_publish set for class %s', cls.__name__)
+            Command topics go under command_root_topic if given, otherwise root_topic.'''
+            self.root_topic = root_topic
+            command_root_topic = command_root_topic or root_topic
+            self.state_topics = {
+                (spec.component_id, topic.topic): root_topic + topic.suffix
+                for spec in self.component_table for topic in spec.state_topics
+            }
+            self.command_topics = {
+                (spec.component_id, topic.topic): command_root_topic + topic.suffix
+                for spec in self.component_table for topic in spec.command_topics
+            }
 
         cls.on_publish = on_publish
-        return cls(*args, **kwargs)
+        cls.bind_topics = bind_topics
+
+    def __call__(self, *args, **kwargs):
+        print('Created MqttDevice for ', self.cls.__name__)
+        return self.cls(*args, **kwargs)
+
+class LastValueCache():
+    '''Last payload sent to each topic, used to suppress unchanged publishes.
+
+    A payload is suppressed if it equals the last one sent, or if both are
+    numbers within the component's deadband. Every topic is re-sent at least
+    every refresh_seconds regardless.'''
+    def __init__(self, refresh_seconds=PUBLISH_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self.values = {}
+        self.published = 0
+        self.suppressed = 0
+
+    @staticmethod
+    def _as_number(payload):
+        try:
+            return float(payload)
+        except (TypeError, ValueError):
+            return None
+
+    def should_publish(self, topic: str, payload, deadband=None):
+        now = time.monotonic()
+        number = self._as_number(payload) if deadband else None
+        last = self.values.get(topic)
+        if last is not None and now - last[2] < self.refresh_seconds:
+            (last_payload, last_number, _) = last
+            unchanged = payload == last_payload or (
+                number is not None and last_number is not None and abs(number - last_number) < deadband)
+            if unchanged:
+                self.suppressed += 1
+                return False
+        self.values[topic] = (payload, number, now)
+        self.published += 1
+        return True
+
+class PublishThrottle():
+    '''Limits each topic to one publish per min_interval.
+
+    Values arriving within the interval are held, and the latest is sent
+    when the interval is up.'''
+    def __init__(self):
+        self.sent_at = {}
+        self.held = {}
+        self.tasks = set()
+        self.throttled = 0
+
+    async def publish(self, topic: str, payload, min_interval, send):
+        now = time.monotonic()
+        wait = self.sent_at[topic] + min_interval - now if min_interval and topic in self.sent_at else 0
+        if wait <= 0:
+            self.sent_at[topic] = now
+            await send(topic, payload)
+            return
+        self.throttled += 1
+        if topic not in self.held:
+            task = asyncio.create_task(self._send_held(topic, wait))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        self.held[topic] = (payload, send)
+
+    async def _send_held(self, topic: str, wait: float):
+        await asyncio.sleep(wait)
+        (payload, send) = self.held.pop(topic)
+        self.sent_at[topic] = time.monotonic()
+        await send(topic, payload)
+
+class StateDocument():
+    '''All of a device's state values, published as one JSON document.
+
+    Updates are collected for flush_seconds and then sent together, so a
+    device sends one message per poll cycle instead of one per value. Every
+    value starts as null, and the templates render it as unknown until it is
+    reported.
+    Camera images stay on their own topics.'''
+    def __init__(self, topic: str, component_table, send, flush_seconds=STATE_DOCUMENT_FLUSH_SECONDS):
+        self.topic = topic
+        self.send = send
+        self.flush_seconds = flush_seconds
+        self.values = {
+            spec.component_id: {topic.topic: None for topic in spec.state_topics}
+            for spec in component_table
+            if spec.component.component_config['platform'] != TYPE_CAMERA and spec.state_topics
+        }
+        self.flushing = False
+        self.task = None
+
+    def contains(self, component_id: str):
+        return component_id in self.values
+
+    def update(self, component_id: str, topic: str, payload):
+        if isinstance(payload, (bytes, bytearray)):
+            payload = payload.decode()
+        try:
+            payload = json.loads(payload)
+        except json.JSONDecodeError:
+            pass # just use the string
+        self.values[component_id][topic] = payload
+        if not self.flushing:
+            self.flushing = True
+            self.task = asyncio.create_task(self._flush())
 
-    # Read through all attributes of the class.
-    # Add fields and functions for setting the root topic.
+    async def _flush(self):
+        await asyncio.sleep(self.flush_seconds)
+        self.flushing = False
+        await self.send(self.topic, json.dumps(self.values))
 
-    def set_device_topic(topic: str):
-        '''Set the root topic for this device - used when publishing.'''
+    def component_config(self, spec: ComponentSpec, config: dict):
+        '''Point a component's discovery config at this document instead of its own state topics.'''
+        for topic in spec.state_topics:
+            config[topic.config_key] = self.topic
+            template_key = 'value_template' if topic.topic == 'state' else topic.topic + '_template'
+            value = "value_json['{0}']['{1}']".format(spec.component_id, topic.topic)
+            # Unreported values are null, and must come out as None, which HA reads as unknown.
+            if template_key in config:
+                config[template_key] = ('{% set value_json = ' + value + ' %}'
+                    '{% if value_json is none %}None{% else %}' + config[template_key] + '{% endif %}')
+            elif topic.topic == 'json_attributes':
+                config[template_key] = '{{ (' + value + ' or {}) | tojson }}'
+            else:
+                config[template_key] = '{{ ' + value + ' }}'
+        return config
 
-    def publish(component_fn: function):
-        '''Publish the value of the associated function to its MQTT topic.'''
+class PublishedSnapshot():
+    '''The last message sent to each discovery and state topic, except binary
+    ones such as camera images, which are large and soon replaced anyway.
+
+    Kept so that everything can be re-sent when Home Assistant restarts,
+    without asking the devices again. Discovery goes first, then state once
+    HA has had settle_seconds to set up the entities, in batches of batch
+    messages every interval seconds.'''
+    def __init__(self, batch=REPUBLISH_BATCH, interval=REPUBLISH_INTERVAL_SECONDS, settle_seconds=REPUBLISH_SETTLE_SECONDS):
+        self.batch = batch
+        self.interval = interval
+        self.settle_seconds = settle_seconds
+        self.discovery = {}
+        self.states = {}
+        self.task = None
+        self.republished = 0
+
+    def record(self, topic: str, payload, qos=0, retain=False, discovery=False):
+        if isinstance(payload, (bytes, bytearray)):
+            return
+        (self.discovery if discovery else self.states)[topic] = (payload, qos, retain)
+
+    def republish(self, send):
+        '''Re-send everything with send(topic, payload, qos, retain), restarting if already under way.'''
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.task = asyncio.get_running_loop().create_task(self._republish(send))
+
+    async def _republish(self, send):
+        logging.info('Home Assistant restarted, re-sending %d discovery and %d state messages',
+            len(self.discovery), len(self.states))
+        await self._send_all(list(self.discovery.items()), send)
+        await asyncio.sleep(self.settle_seconds)
+        await self._send_all(list(self.states.items()), send)
+
+    async def _send_all(self, messages, send):
+        for start in range(0, len(messages), self.batch):
+            for (topic, (payload, qos, retain)) in messages[start:start + self.batch]:
+                await send(topic, payload, qos=qos, retain=retain)
+                self.republished += 1
+            await asyncio.sleep(self.interval)
+
+def discovery_payload(config: dict):
+    '''Canonical JSON for a discovery config, so equal configs are byte-for-byte equal.'''
+    return json.dumps(config, sort_keys=True, separators=(',', ':'))
+
+def content_hash(payload):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return hashlib.sha256(payload).hexdigest()
+
+class RetainedDiscovery():
+    '''Content hashes of the discovery configs retained on the broker.
+
+    Fed from a subscription to the discovery topics at startup, so that
+    configs which haven't changed since the last run needn't be re-sent.
+    Topics that don't start with prefix are ignored.'''
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.hashes = {}
+        self.published = 0
+        self.skipped = 0
+
+    def on_message(self, client, userdata, message):
+        if not message.retain or not message.topic.startswith(self.prefix):
+            return
+        if message.payload:
+            self.hashes[message.topic] = content_hash(message.payload)
+        else:
+            self.hashes.pop(message.topic, None)
+
+    def topics(self):
+        return list(self.hashes)
+
+    def forget(self, topic: str):
+        self.hashes.pop(topic, None)
+
+    def should_publish(self, topic: str, payload):
+        digest = content_hash(payload)
+        if self.hashes.get(topic) == digest:
+            self.skipped += 1
+            return False
+        self.hashes[topic] = digest
+        self.published += 1
+        return True
+
+# The state topic that shows the result of each kind of command topic.
+COMMAND_STATE_TOPICS = {
+    'command': 'state',
+    'temperature_command': 'temperature_state',
+    'mode_command': 'mode_state',
+}
+
+def command_state_topic(component, command_topic: str):
+    '''The component's state topic that reflects command_topic, or None.'''
+    state_topic = COMMAND_STATE_TOPICS.get(command_topic)
+    return state_topic if state_topic in component.subscription_topic_map else None
 
 def component(
         platform=TYPE_SENSOR,
         subscription_topics=['state', 'json_attributes'], 
         command_topics=[],
+        deadband=None,
+        poll_interval=None,
+        poll_timeout=None,
+        qos=None,
+        retain=None,
+        min_interval=None,
         **kwargs):
     def component(func):
         def state(self, *args, **kwargs):
@@ -60,9 +317,11 @@ def component(
         state.on_publish = None
         
         # TODO: Move this to a set of helper functions to remove asyncio in this module.
-        async def publish(self, *args, **kwargs):
+        async def publish(self, *args, topics=None, **kwargs):
             try:
-                iterable_topics = [(topic, fn) for topic, fn in state.subscription_topic_map.items()]
+                iterable_topics = [
+                    (topic, fn) for topic, fn in state.subscription_topic_map.items()
+                    if topics is None or topic in topics]
                 topics = [topic for topic, fn in iterable_topics ]
                 results = await asyncio.gather(
                     *[fn(self, *args, **kwargs) for (topic, fn) in iterable_topics],
@@ -72,10 +331,9 @@ def component(
                         continue
                     if isinstance(result, Exception):
                         continue
-                    if not isinstance(result, str) and not isinstance(result, bytearray):
+                    if not isinstance(result, (str, bytes, bytearray)):
                         result = json.dumps(result)
-                    #state.on_publish(state, topic, result)
-                    self.on_publish(state, topic, result)
+                    await self.on_publish(state, topic, result)
             except Exception as ex:
                 logging.error(ex)
                 sys.exit(-1)
@@ -101,6 +359,13 @@ def component(
                 setattr(state, topic, partial(topic_setter, topic_map=topic_map, topic=topic))
 
         state.component_id = func.__name__
+        state.deadband = deadband
+        state.poll_interval = poll_interval
+        state.poll_timeout = poll_timeout
+        (default_qos, default_retain, default_min_interval) = PUBLISH_POLICIES.get(platform, PUBLISH_POLICY_DEFAULT)
+        state.qos = default_qos if qos is None else qos
+        state.retain = default_retain if retain is None else retain
+        state.min_interval = default_min_interval if min_interval is None else min_interval
         state.component_config = kwargs
         state.component_config['platform'] = platform
         return state
@@ -121,6 +386,17 @@ def binary_sensor(
         return state
     return binary_sensor
 
+def button(**kwargs):
+    def button(func):
+        state = component(
+            platform=TYPE_BUTTON,
+            subscription_topics=[],
+            command_topics=['command'],
+            poll_interval=POLL_EVENTS_ONLY,
+            **kwargs)(func)
+        return state
+    return button
+
 def switch(
         device_class=DEVICE_CLASS_SWITCH,
         unit_of_measurement=UNIT_OF_MEASUREMENT_NONE,
@@ -172,11 +448,12 @@ def climate(**kwargs):
         return state
     return climate
 
-def camera(**kwargs):
+def camera(poll_interval=POLL_EVENTS_ONLY, **kwargs):
     def camera(func):
         state = component(
             platform=TYPE_CAMERA,
             subscription_topics=['', 'json_attributes'],
+            poll_interval=poll_interval,
             **kwargs)(func)
         
         return state
@@ -0,0 +1,36 @@
+""" Local HTTP server for data that doesn't suit MQTT, e.g. on-demand images. """
+
+import logging
+
+from aiohttp import web
+
+from const import HTTP_SERVER_HOST, HTTP_SERVER_PORT
+
+
+class HttpServer:
+    """ A single aiohttp server shared by all connections.
+
+    Each connection's routes are mounted under /<connection name>.
+    Routes must be added before start().
+    """
+    def __init__(self, host=HTTP_SERVER_HOST, port=HTTP_SERVER_PORT):
+        self.host = host
+        self.port = port
+        self.app = web.Application()
+        self.runner = None
+
+    def add_routes(self, prefix: str, routes):
+        for (method, path, handler) in routes:
+            logging.info('HTTP route %s %s', method, prefix + path)
+            self.app.router.add_route(method, prefix + path, handler)
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        logging.info('HTTP server listening on %s:%d', self.host, self.port)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
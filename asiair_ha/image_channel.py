@@ -0,0 +1,119 @@
+""" Image transfer from the ASIAIR (port 4800) and tracking of image consumers. """
+
+import asyncio
+import json
+import logging
+import struct
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+
+from const import IMAGE_CHANNEL_RECONNECT_MAX_SECONDS, IMAGE_DEMAND_WINDOW_SECONDS
+
+# 80 byte header sent before each zipped image.
+# Byte 6-9 - size
+# Byte 16,17 - width
+# Byte 18,19 - height
+IMAGE_HEADER = struct.Struct("!xxxxxxIxxxxxxHHxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx")
+IMAGE_CHUNK_SIZE = 4*1024*1024
+
+
+class ImageDemand:
+    """ Tracks whether anyone has asked for an image recently.
+
+    Consumers (MQTT "wanted" presses, HTTP hits on the image endpoint) call
+    touch(); images are considered wanted for window_seconds afterwards.
+    """
+    def __init__(self, window_seconds=IMAGE_DEMAND_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self.last_request = None
+        self.requested = asyncio.Event()
+
+    def touch(self, source: str = ''):
+        logging.debug('Image requested by %s', source)
+        self.last_request = time.monotonic()
+        self.requested.set()
+
+    def is_wanted(self):
+        if self.last_request is None:
+            return False
+        return time.monotonic() - self.last_request < self.window_seconds
+
+    async def wait_until_wanted(self):
+        while not self.is_wanted():
+            self.requested.clear()
+            await self.requested.wait()
+
+
+class ImageChannel:
+    """ A persistent connection to the ASIAIR image port.
+
+    The connection is opened on first use and kept between frames. If the
+    ASIAIR drops it, it is re-opened (with backoff) and the request retried.
+    """
+    def __init__(self, host: str, port: int = 4800, open_connection=asyncio.open_connection):
+        self.host = host
+        self.port = port
+        self.open_connection = open_connection
+        self.reader = None
+        self.writer = None
+        self.id = 1
+        self.reconnects = 0
+        self.lock = asyncio.Lock()
+
+    async def _connect(self):
+        backoff = 1
+        while self.writer is None:
+            try:
+                logging.info('Connecting to image port %s:%d', self.host, self.port)
+                self.reader, self.writer = await self.open_connection(self.host, self.port)
+            except OSError as ex:
+                logging.warning('Image port connection failed (%s), retrying in %ds', ex, backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, IMAGE_CHANNEL_RECONNECT_MAX_SECONDS)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def fetch(self):
+        """ Download the current image as a 2D uint16 array, or None if there isn't one. """
+        async with self.lock:
+            for attempt in range(2):
+                await self._connect()
+                try:
+                    return await self._get_current_img()
+                except (asyncio.IncompleteReadError, ConnectionError, OSError) as ex:
+                    logging.warning('Image port connection lost (%s), reconnecting', ex)
+                    self.close()
+                    self.reconnects += 1
+            return None
+
+    async def _get_current_img(self):
+        self.writer.write((json.dumps({"id": self.id, "method": "get_current_img"}) + "\r\n").encode())
+        await self.writer.drain()
+        self.id += 1
+
+        header = await self.reader.readexactly(IMAGE_HEADER.size)
+        (size, width, height) = IMAGE_HEADER.unpack(header)
+        logging.debug('%d Header %s', self.port, (size, width, height))
+        if width <= 0:
+            logging.warning('%d Width <= 0 => %s', self.port, header)
+            return None
+
+        logging.debug('%d Zipped Image Size: %d %dx%d', self.port, size, width, height)
+        with tempfile.TemporaryFile("w+b") as f:
+            remaining = size
+            while remaining > 0:
+                chunk = await self.reader.read(min(remaining, IMAGE_CHUNK_SIZE))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                f.write(chunk)
+                remaining = remaining - len(chunk)
+            f.seek(0)
+            with zipfile.ZipFile(f) as z, z.open("raw_data", mode="r") as rawData:
+                return np.ndarray(shape=(height, width), dtype="<u2", buffer=rawData.read())
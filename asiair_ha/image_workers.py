@@ -0,0 +1,24 @@
+""" The thread pool shared by every connection's image processing. """
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from const import IMAGE_WORKER_THREADS
+
+_executor = None
+
+
+def image_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=IMAGE_WORKER_THREADS, thread_name_prefix='image')
+    return _executor
+
+
+async def run_image_job(fn, *args):
+    """ Run fn(*args) on the shared pool.
+
+    Jobs start in the order they were submitted. Each rig only has one frame
+    in processing at a time, so with several rigs this takes turns between them.
+    """
+    return await asyncio.get_running_loop().run_in_executor(image_executor(), fn, *args)
@@ -0,0 +1,102 @@
+""" Incremental live stacking of binned frames. """
+
+import logging
+import threading
+
+import cv2
+import numpy as np
+
+from const import STACK_MAX_SHIFT_FRACTION, STACK_MIN_CORRELATION
+
+
+class LiveStack:
+    """ A running mean of frames registered to the first frame of the stack.
+
+    Registration uses FFT phase correlation against the reference frame's
+    spectrum, which is computed once. Memory use is the accumulator, the
+    reference spectrum and per-frame scratch space, however long the stack runs.
+    Frames are added on the image pool, so add and reset hold a lock.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self._reset()
+
+    def _reset(self):
+        self.accumulator = None
+        self.reference_spectrum = None
+        self.window = None
+        self.count = 0
+        self.rejected = 0
+
+    def add(self, frame):
+        """ Register and add a float32 frame. Returns True if it was stacked. """
+        with self.lock:
+            return self._add(frame)
+
+    def _add(self, frame):
+        if self.accumulator is None or frame.shape != self.accumulator.shape:
+            if self.accumulator is not None:
+                logging.info('Frame size changed, restarting live stack')
+            self._reset()
+            h, w = frame.shape
+            self.window = cv2.createHanningWindow((w, h), cv2.CV_32F)
+            self.reference_spectrum = np.conj(self._spectrum(frame))
+            self.accumulator = frame.astype(np.float32, copy=True)
+            self.count = 1
+            return True
+
+        (response, dy, dx) = self._register(frame)
+        h, w = frame.shape
+        if response < STACK_MIN_CORRELATION or max(abs(dy) / h, abs(dx) / w) > STACK_MAX_SHIFT_FRACTION:
+            logging.info('Live stack rejected frame (response %.3f, shift %.1f, %.1f)', response, dx, dy)
+            self.rejected += 1
+            return False
+
+        aligned = cv2.warpAffine(
+            frame.astype(np.float32, copy=False),
+            np.float32([[1, 0, -dx], [0, 1, -dy]]),
+            (w, h),
+            flags=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_REPLICATE)
+
+        # Running mean, in place: acc += (aligned - acc) / n
+        self.count += 1
+        np.subtract(aligned, self.accumulator, out=aligned)
+        np.multiply(aligned, 1 / self.count, out=aligned)
+        np.add(self.accumulator, aligned, out=self.accumulator)
+        logging.debug('Live stack: %d frames, shift %.2f, %.2f', self.count, dx, dy)
+        return True
+
+    def _spectrum(self, frame):
+        # Remove the background so the correlation is dominated by stars.
+        x = frame - np.median(frame)
+        np.clip(x, 0, None, out=x)
+        np.multiply(x, self.window, out=x)
+        return np.fft.rfft2(x)
+
+    def _register(self, frame):
+        """ Returns (peak response, dy, dx) of frame relative to the reference. """
+        cross_power = self._spectrum(frame)
+        cross_power *= self.reference_spectrum
+        cross_power /= np.abs(cross_power) + 1e-12
+        correlation = np.fft.irfft2(cross_power, s=frame.shape)
+
+        h, w = correlation.shape
+        (py, px) = np.unravel_index(np.argmax(correlation), correlation.shape)
+        response = correlation[py, px]
+
+        def refine(before, peak, after):
+            denominator = before - 2 * peak + after
+            return 0 if denominator == 0 else 0.5 * (before - after) / denominator
+
+        dy = py + refine(correlation[py - 1, px], response, correlation[(py + 1) % h, px])
+        dx = px + refine(correlation[py, px - 1], response, correlation[py, (px + 1) % w])
+        if dy > h / 2:
+            dy -= h
+        if dx > w / 2:
+            dx -= w
+        return (response, dy, dx)
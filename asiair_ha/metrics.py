@@ -0,0 +1,171 @@
+""" Counters, gauges and histograms for the bridge, in Prometheus text format.
+
+Metrics are created at module level by the code they measure and collected
+into one registry, which is served at /metrics on the HTTP server. Values
+may be updated from the image worker threads, so updates hold a lock.
+"""
+
+import bisect
+import threading
+import time
+
+from aiohttp import web
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+# Seconds; suits both RPC round trips and image processing stages.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for (name, value) in pairs) + '}'
+
+
+class Metric:
+    """ A named family of samples, one per combination of label values.
+
+    If fn is given, the samples are read from it at scrape time instead; it
+    returns {label values tuple: value}. This suits counts that something
+    else already keeps, such as queue lengths.
+    """
+    type = None
+    # Unlabelled metrics start from this, so they are scraped before their first update.
+    initial = 0
+
+    def __init__(self, name: str, help: str, labelnames=(), fn=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self.values = {}
+        if not self.labelnames and self.initial is not None:
+            self.values[()] = self.initial
+        self.lock = threading.Lock()
+
+    def _key(self, labels: dict):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self):
+        """ (suffix, label values, extra labels, value) for each sample. """
+        if self.fn is not None:
+            return [('', key, (), value) for (key, value) in self.fn().items()]
+        with self.lock:
+            return [('', key, (), value) for (key, value) in self.values.items()]
+
+    def render(self):
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.help.replace('\\', '\\\\').replace('\n', '\\n')),
+            '# TYPE {0} {1}'.format(self.name, self.type),
+        ]
+        for (suffix, key, extra, value) in self.samples():
+            lines.append('{0}{1}{2} {3}'.format(
+                self.name, suffix, _format_labels(self.labelnames, key, extra), float(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    initial = None
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            (counts, total) = self.values.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = [(key, list(counts), total) for (key, (counts, total)) in self.values.items()]
+        for (key, counts, total) in items:
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', key, (('le', '+Inf' if bound == float('inf') else bound),), cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), cumulative))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric):
+        """ Add a metric. One read from fn replaces an earlier one of the same name
+        read from fn, as these are registered again each time the bridge starts. """
+        old = self.metrics.get(metric.name)
+        if old is not None and not (old.fn is not None and metric.fn is not None and type(old) is type(metric)):
+            raise ValueError('Metric {0} is already registered'.format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str, labelnames=(), fn=None):
+    return REGISTRY.register(Counter(name, help, labelnames, fn))
+
+
+def gauge(name: str, help: str, labelnames=(), fn=None):
+    return REGISTRY.register(Gauge(name, help, labelnames, fn))
+
+
+def histogram(name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labelnames, buckets))
+
+
+async def http_metrics(request):
+    return web.Response(text=REGISTRY.render(), headers={'Content-Type': CONTENT_TYPE})
+
+
+def http_routes():
+    return [('GET', '/metrics', http_metrics)]
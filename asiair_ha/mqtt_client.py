@@ -0,0 +1,334 @@
+""" asyncio-native MQTT client.
+
+paho-mqtt is driven from the event loop through its socket callbacks instead of
+loop_start()'s background thread, so publishes, subscription callbacks and
+reconnects all happen on the loop. Only the blocking connect runs on a worker
+thread, and the socket callbacks it makes are passed back to the loop.
+"""
+
+import asyncio
+import base64
+from collections import OrderedDict
+from functools import partial
+import json
+import logging
+import os
+
+import paho.mqtt.client as mqtt
+
+from const import (
+    MQTT_BUFFER_FLUSH_BATCH,
+    MQTT_BUFFER_FLUSH_INTERVAL_SECONDS,
+    MQTT_BUFFER_MAX_BYTES,
+    MQTT_BUFFER_MAX_TOPICS,
+    MQTT_BUFFER_SPILL_PATH,
+    MQTT_CONNECT_TIMEOUT_SECONDS,
+    MQTT_KEEPALIVE_SECONDS,
+    MQTT_MAX_INFLIGHT,
+    MQTT_RECONNECT_MAX_SECONDS,
+)
+import metrics
+
+PUBLISHED_MESSAGES = metrics.counter('astro_mqtt_mqtt_published_messages_total', 'Messages handed to the MQTT client.')
+PUBLISHED_BYTES = metrics.counter('astro_mqtt_mqtt_published_bytes_total', 'Payload bytes handed to the MQTT client.')
+RECONNECTS = metrics.counter('astro_mqtt_mqtt_reconnects_total', 'Successful reconnections to the MQTT broker.')
+
+
+def payload_size(payload):
+    if payload is None:
+        return 0
+    if isinstance(payload, str):
+        return len(payload.encode())
+    if isinstance(payload, (bytes, bytearray)):
+        return len(payload)
+    return len(str(payload))
+
+
+class AsyncMqttClient:
+    """ Awaitable publishes, with qos > 0 limited to a window of max_inflight un-acked messages.
+
+    Subscriptions are remembered and re-sent, in a single SUBSCRIBE, whenever
+    the connection is (re-)established.
+    """
+    def __init__(self, client_id='', max_inflight=MQTT_MAX_INFLIGHT, userdata=None):
+        self.loop = None
+        self.client = mqtt.Client(
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+            client_id=client_id,
+            userdata=userdata)
+        self.client.max_inflight_messages_set(max_inflight)
+        self.inflight = asyncio.Semaphore(max_inflight)
+        self.pending = {}
+        self.subscriptions = {}
+        self.connected = asyncio.Event()
+        # The outcome of the first connect(), failed if the broker refuses it.
+        self.connect_result = None
+        self.closing = False
+        self.misc_task = None
+        self.reconnect_task = None
+        # Called with no arguments each time the connection is (re-)established.
+        self.connect_listeners = []
+
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.client.on_socket_open = partial(self._in_loop, self._on_socket_open)
+        self.client.on_socket_close = partial(self._in_loop, self._on_socket_close)
+        self.client.on_socket_register_write = partial(self._in_loop, self._on_socket_register_write)
+        self.client.on_socket_unregister_write = partial(self._in_loop, self._on_socket_unregister_write)
+
+    async def connect(self, host: str, port: int = 1883, username=None, password=None, keepalive=MQTT_KEEPALIVE_SECONDS, timeout=MQTT_CONNECT_TIMEOUT_SECONDS):
+        """ Connect to the broker, raising if it can't be reached or refuses the connection. """
+        self.loop = asyncio.get_running_loop()
+        if username and password:
+            self.client.username_pw_set(username=username, password=password)
+        self.connect_result = self.loop.create_future()
+        try:
+            await self.loop.run_in_executor(None, self.client.connect, host, port, keepalive)
+            await asyncio.wait_for(asyncio.shield(self.connect_result), timeout)
+        except BaseException:
+            # Don't let the disconnect that follows start reconnecting.
+            await self.disconnect()
+            raise
+
+    async def disconnect(self):
+        self.closing = True
+        self.client.disconnect()
+
+    def is_connected(self):
+        return self.connected.is_set()
+
+    async def publish(self, topic: str, payload, qos=0, retain=False, wait=False):
+        """ Publish a message, waiting for space in the in-flight window if qos > 0.
+
+        With wait=True, also wait for the broker's acknowledgement.
+        Returns paho's result code.
+        """
+        if qos > 0:
+            await self.inflight.acquire()
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        if info.rc in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+            # Sent, or queued by paho until the connection returns.
+            PUBLISHED_MESSAGES.inc()
+            PUBLISHED_BYTES.inc(payload_size(payload))
+        if qos == 0 or info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+            if qos > 0:
+                self.inflight.release()
+            return info.rc
+        # paho keeps qos > 0 messages while disconnected and sends them on reconnect.
+        future = self.loop.create_future()
+        self.pending[info.mid] = future
+        if wait:
+            await future
+        return info.rc
+
+    def subscribe(self, topic: str, callback=None, qos=0):
+        """ Subscribe to topic, routing its messages to callback(client, userdata, message). """
+        self.subscriptions[topic] = qos
+        if callback is not None:
+            self.client.message_callback_add(topic, callback)
+        if self.is_connected():
+            self.client.subscribe(topic, qos)
+
+    def unsubscribe(self, topic: str):
+        self.subscriptions.pop(topic, None)
+        self.client.message_callback_remove(topic)
+        if self.is_connected():
+            self.client.unsubscribe(topic)
+
+    def will_set(self, topic: str, payload, qos=0, retain=False):
+        self.client.will_set(topic, payload, qos=qos, retain=retain)
+
+    def _in_loop(self, callback, *args):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            callback(*args)
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            logging.error('MQTT connection refused: %s', reason_code)
+            if not self.connect_result.done():
+                self.connect_result.set_exception(ConnectionRefusedError('MQTT connection refused: {0}'.format(reason_code)))
+            return
+        logging.info('MQTT connected')
+        if self.subscriptions:
+            client.subscribe(list(self.subscriptions.items()))
+        self.connected.set()
+        if not self.connect_result.done():
+            self.connect_result.set_result(None)
+        for listener in self.connect_listeners:
+            listener()
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self.connected.clear()
+        if self.closing:
+            logging.info('MQTT disconnected')
+            return
+        logging.warning('MQTT disconnected: %s', reason_code)
+        if self.reconnect_task is None or self.reconnect_task.done():
+            self.reconnect_task = self.loop.create_task(self._reconnect())
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        future = self.pending.pop(mid, None)
+        if future is not None:
+            self.inflight.release()
+            if not future.done():
+                future.set_result(mid)
+
+    async def _reconnect(self):
+        backoff = 1
+        while True:
+            await asyncio.sleep(backoff)
+            if self.closing or self.is_connected():
+                return
+            try:
+                logging.info('MQTT reconnecting')
+                await self.loop.run_in_executor(None, self.client.reconnect)
+                await asyncio.wait_for(self.connected.wait(), MQTT_KEEPALIVE_SECONDS)
+                RECONNECTS.inc()
+            except (OSError, asyncio.TimeoutError) as ex:
+                logging.warning('MQTT reconnect failed: %s', ex)
+                backoff = min(backoff * 2, MQTT_RECONNECT_MAX_SECONDS)
+
+    # Socket callbacks: hand paho's socket to the event loop.
+    def _on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc_task = self.loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc_task is not None:
+            self.misc_task.cancel()
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def _misc_loop(self):
+        # Keepalive pings and retries.
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+class PublishBuffer:
+    """ Store-and-forward for publishes made while the broker is unreachable.
+
+    Only the latest message per topic is kept, up to max_topics topics and
+    max_bytes of payload. Beyond that the least recently updated topics are
+    appended to spill_path, if set, or dropped. On reconnect everything is
+    sent, oldest first, in batches of flush_batch every flush_interval
+    seconds. Until the buffer is empty new messages join it rather than
+    overtaking it.
+    """
+    def __init__(self, client: AsyncMqttClient,
+            max_topics=MQTT_BUFFER_MAX_TOPICS,
+            max_bytes=MQTT_BUFFER_MAX_BYTES,
+            spill_path=MQTT_BUFFER_SPILL_PATH,
+            flush_batch=MQTT_BUFFER_FLUSH_BATCH,
+            flush_interval=MQTT_BUFFER_FLUSH_INTERVAL_SECONDS):
+        self.client = client
+        self.max_topics = max_topics
+        self.max_bytes = max_bytes
+        self.spill_path = os.path.expanduser(spill_path) if spill_path else None
+        self.flush_batch = flush_batch
+        self.flush_interval = flush_interval
+        self.messages = OrderedDict()
+        self.bytes = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.flush_task = None
+        if self.spill_path is not None and os.path.exists(self.spill_path):
+            # Left over from an earlier run, and out of date by now.
+            os.remove(self.spill_path)
+        client.connect_listeners.append(self._on_connect)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def is_flushing(self):
+        return self.flush_task is not None and not self.flush_task.done()
+
+    async def publish(self, topic: str, payload, qos=0, retain=False):
+        if self.client.is_connected() and not self.messages and not self.is_flushing():
+            return await self.client.publish(topic, payload, qos=qos, retain=retain)
+        if not self.messages:
+            logging.warning('MQTT unavailable, buffering publishes')
+        self._store(topic, payload, qos, retain)
+
+    def _store(self, topic: str, payload, qos, retain):
+        old = self.messages.pop(topic, None)
+        if old is not None:
+            self.bytes -= payload_size(old[0])
+        self.messages[topic] = (payload, qos, retain)
+        self.bytes += payload_size(payload)
+        while len(self.messages) > self.max_topics or self.bytes > self.max_bytes:
+            (old_topic, (old_payload, old_qos, old_retain)) = self.messages.popitem(last=False)
+            self.bytes -= payload_size(old_payload)
+            if self.spill_path is not None:
+                self._spill(old_topic, old_payload, old_qos, old_retain)
+            else:
+                self.dropped += 1
+
+    def _spill(self, topic: str, payload, qos, retain):
+        if payload is None:
+            payload = b''
+        elif not isinstance(payload, (bytes, bytearray)):
+            payload = str(payload).encode()
+        with open(self.spill_path, 'a') as spill:
+            spill.write(json.dumps({
+                'topic': topic,
+                'payload': base64.b64encode(payload).decode(),
+                'qos': qos,
+                'retain': retain,
+            }) + '\n')
+        self.spilled += 1
+
+    def _unspill(self):
+        """ Spilled messages not superseded by ones still in memory, oldest first. """
+        if self.spill_path is None or not os.path.exists(self.spill_path):
+            return []
+        spilled = OrderedDict()
+        with open(self.spill_path) as spill:
+            for line in spill:
+                message = json.loads(line)
+                spilled.pop(message['topic'], None)
+                spilled[message['topic']] = (base64.b64decode(message['payload']), message['qos'], message['retain'])
+        os.remove(self.spill_path)
+        return [(topic, message) for (topic, message) in spilled.items() if topic not in self.messages]
+
+    def _on_connect(self):
+        has_spill = self.spill_path is not None and os.path.exists(self.spill_path)
+        if (self.messages or has_spill) and not self.is_flushing():
+            self.flush_task = asyncio.get_running_loop().create_task(self._flush())
+
+    async def _flush(self):
+        spilled = self._unspill()
+        logging.info('MQTT reconnected, sending %d buffered messages', len(spilled) + len(self.messages))
+        while spilled and self.client.is_connected():
+            (batch, spilled) = (spilled[:self.flush_batch], spilled[self.flush_batch:])
+            for (topic, (payload, qos, retain)) in batch:
+                if topic not in self.messages:
+                    await self.client.publish(topic, payload, qos=qos, retain=retain)
+                    self.flushed += 1
+            await asyncio.sleep(self.flush_interval)
+        for (topic, (payload, qos, retain)) in spilled:
+            # Disconnected again part way through; spill what's left again, so
+            # that it is still sent before the newer messages in memory.
+            if topic not in self.messages:
+                self._spill(topic, payload, qos, retain)
+
+        while self.messages and self.client.is_connected():
+            for _ in range(min(self.flush_batch, len(self.messages))):
+                (topic, (payload, qos, retain)) = self.messages.popitem(last=False)
+                self.bytes -= payload_size(payload)
+                await self.client.publish(topic, payload, qos=qos, retain=retain)
+                self.flushed += 1
+            await asyncio.sleep(self.flush_interval)
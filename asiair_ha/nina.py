@@ -1,7 +1,6 @@
 import json
 import logging
 import aiohttp
-import asyncio
 
 from const import DEVICE_TYPE_CAMERA_ICON
 from hass_mqtt import climate, mqtt_device, sensor
@@ -9,6 +8,8 @@ from observatory_software import Camera, Device, ObservatorySoftware
 
 
 class Nina(ObservatorySoftware):
+    poll_interval = 20
+
     def __init__(self, name, host='localhost', port='1888'):
         self.host = host
         self.port = port
@@ -24,18 +25,15 @@ class Nina(ObservatorySoftware):
 
 
     async def connect(self):
+        if self.session is not None:
+            await self.session.close()
         self.session = aiohttp.ClientSession('http://{0}:{1}/v2/api/'.format(self.host, self.port))
+        # Fail here, rather than on the first poll, if NINA isn't running.
+        await self._get('version')
 
     async def discover(self):
         return self.devices
 
-    async def poll(self):
-        while True:
-            for device in self.devices.values():
-                for component in device.components():
-                    await component.publish(device)
-            await asyncio.sleep(20)
-    
     async def _get(self, path, **kwargs):
         async with self.session.get(path, params=kwargs) as response:
             print(response)
@@ -86,6 +84,7 @@ class NinaCamera(NinaDevice, Camera):
     @climate(
         name='Cooling',
         temperature_unit='C',
+        deadband=0.1,
         icon='mdi:snowflake',
         max_temp=40,
         min_temp=-40,
@@ -14,8 +14,9 @@
 # One challenge of abstractions here is that we often end up
 # sending multiple updates.
 
+import asyncio
 import logging
-from const import DEVICE_TYPE_CAMERA_ICON, STATE_CLASS_MEASUREMENT, UNIT_OF_MEASUREMENT_NONE, UNIT_OF_MEASUREMENT_PERCENTAGE, UNIT_OF_MEASUREMENT_SECONDS
+from const import DEVICE_TYPE_CAMERA_ICON, POLL_CONCURRENCY, STATE_CLASS_MEASUREMENT, UNIT_OF_MEASUREMENT_NONE, UNIT_OF_MEASUREMENT_PERCENTAGE, UNIT_OF_MEASUREMENT_SECONDS
 from hass_mqtt import camera, climate, sensor, switch
 
 
@@ -23,6 +24,9 @@ class ObservatorySoftware:
     """ Root class for all the devices exposed by a piece of observatory software.
     """
     update = None
+    # Default seconds between polls of each component, and how many may run at once.
+    poll_interval = 30
+    poll_concurrency = POLL_CONCURRENCY
 
     def __init__(self, name):
         self.name = name
@@ -45,8 +49,20 @@ class ObservatorySoftware:
         raise NotImplementedError
     
     async def poll(self):
-        raise NotImplementedError
-    
+        """ Run any background work needed by the connection, e.g. event handling.
+
+        Returns if the connection is lost, after which it is attached again.
+        Software without a persistent connection never returns. Components
+        are polled by the shared PollScheduler, not here.
+        """
+        await asyncio.Event().wait()
+
+    async def close(self):
+        """ Stop any background work, as the bridge shuts down. """
+
+    def http_routes(self):
+        """ (method, path, handler) tuples to serve over HTTP, relative to the connection. """
+        return []
 
     @staticmethod
     def create(name: str, **kwargs):
@@ -54,18 +70,17 @@ class ObservatorySoftware:
 
 class Device:
     """ Root device class which handles MQTT sensor mapping + HA discovery. """
+    # Set per class by @mqtt_device.
+    component_table = ()
+    mqtt_components = ()
+
     def __init__(self, parent: ObservatorySoftware, name: str):
         self.parent = parent
         self.name = name
         super().__init__()
 
     def components(self):
-        components = []
-        for attr_name in dir(self):
-            method = getattr(self, attr_name)
-            if hasattr(method, 'component_config'):
-                components.append(method)
-        return components
+        return self.mqtt_components
 
     def uuid(self):
         raise NotImplementedError
@@ -97,6 +112,7 @@ class Camera(Device):
     @sensor(
         name="Cooler Power",
         unit_of_measurement=UNIT_OF_MEASUREMENT_PERCENTAGE,
+        deadband=1,
         icon=DEVICE_TYPE_CAMERA_ICON,
         state_class=STATE_CLASS_MEASUREMENT,
     ) 
@@ -148,6 +164,7 @@ class Camera(Device):
     @climate(
         name='Cooling',
         temperature_unit='C',
+        deadband=0.1,
         icon='mdi:snowflake',
         max_temp=40,
         min_temp=-40,
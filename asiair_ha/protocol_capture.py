@@ -0,0 +1,275 @@
+""" Recording and replay of ASIAIR protocol traffic.
+
+A capture holds everything sent and received on ports 4400, 4700 and 4800,
+timestamped, so that a night can be replayed through read_events() and
+read_images() later. ZwoAsiair opens its connections through Capture or
+Replay when given capture= or replay= paths.
+
+The file starts with MAGIC and the capture's start time, then one record per
+read or write: CAPTURE_RECORD, followed by its data.
+
+Usage: python protocol_capture.py <capture file>    (summarises a capture)
+"""
+
+import asyncio
+from collections import Counter, defaultdict, deque, namedtuple
+import json
+import logging
+import struct
+import sys
+import time
+import zlib
+
+from const import CAPTURE_COMPRESS_IMAGES, CAPTURE_FLUSH_SECONDS
+
+MAGIC = b'ASIAIRCAP1'
+CAPTURE_HEADER = struct.Struct('<d')
+# Seconds since the start, port, flags, data length.
+CAPTURE_RECORD = struct.Struct('<dHBI')
+FLAG_RECEIVED = 1
+FLAG_ZLIB = 2
+IMAGE_PORT = 4800
+
+Record = namedtuple('Record', ['time', 'port', 'received', 'data'])
+
+
+class Capture:
+    """ Opens connections to the ASIAIR that record their traffic to path. """
+    def __init__(self, path: str, compress_images=CAPTURE_COMPRESS_IMAGES):
+        self.path = path
+        self.compress_images = compress_images
+        self.file = open(path, 'wb')
+        self.start = time.monotonic()
+        self.flushed_at = self.start
+        self.file.write(MAGIC + CAPTURE_HEADER.pack(time.time()))
+        logging.info('Capturing ASIAIR traffic to %s', path)
+
+    async def open_connection(self, host: str, port: int):
+        (reader, writer) = await asyncio.open_connection(host, port)
+        return (CaptureReader(reader, self, port), CaptureWriter(writer, self, port))
+
+    def record(self, port: int, received: bool, data: bytes):
+        if not data:
+            return
+        flags = FLAG_RECEIVED if received else 0
+        if self.compress_images and port == IMAGE_PORT:
+            data = zlib.compress(data)
+            flags |= FLAG_ZLIB
+        now = time.monotonic()
+        self.file.write(CAPTURE_RECORD.pack(now - self.start, port, flags, len(data)))
+        self.file.write(data)
+        if now - self.flushed_at >= CAPTURE_FLUSH_SECONDS:
+            self.file.flush()
+            self.flushed_at = now
+
+    def close(self):
+        self.file.close()
+
+
+class CaptureReader:
+    def __init__(self, reader, capture: Capture, port: int):
+        self.reader = reader
+        self.capture = capture
+        self.port = port
+
+    async def readline(self):
+        data = await self.reader.readline()
+        self.capture.record(self.port, True, data)
+        return data
+
+    async def read(self, n=-1):
+        data = await self.reader.read(n)
+        self.capture.record(self.port, True, data)
+        return data
+
+    async def readexactly(self, n):
+        try:
+            data = await self.reader.readexactly(n)
+        except asyncio.IncompleteReadError as ex:
+            self.capture.record(self.port, True, ex.partial)
+            raise
+        self.capture.record(self.port, True, data)
+        return data
+
+
+class CaptureWriter:
+    def __init__(self, writer, capture: Capture, port: int):
+        self.writer = writer
+        self.capture = capture
+        self.port = port
+
+    def write(self, data):
+        self.capture.record(self.port, False, data)
+        self.writer.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+
+def read_capture(path: str):
+    """ (start time, [Record]) for a capture file. """
+    records = []
+    with open(path, 'rb') as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{0} is not an ASIAIR capture'.format(path))
+        (started,) = CAPTURE_HEADER.unpack(capture.read(CAPTURE_HEADER.size))
+        while True:
+            header = capture.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                # The end, or the last record of a capture that was cut short.
+                break
+            (offset, port, flags, length) = CAPTURE_RECORD.unpack(header)
+            data = capture.read(length)
+            if len(data) < length:
+                break
+            if flags & FLAG_ZLIB:
+                data = zlib.decompress(data)
+            records.append(Record(offset, port, bool(flags & FLAG_RECEIVED), data))
+    return (started, records)
+
+
+def parse_message(line: bytes):
+    """ A JSON-RPC line as read_events() decodes it, or None. """
+    try:
+        message = json.loads(line.decode('iso-8859-1'))
+    except ValueError:
+        return None
+    return message if isinstance(message, dict) else None
+
+
+class Replay:
+    """ Stands in for the ASIAIR, playing back a capture.
+
+    Events and other unsolicited messages are played back at the times they
+    were captured, or as fast as they are read if realtime is False. Requests
+    are answered with the next captured response to the same method, with
+    the id rewritten; the last one is repeated once they run out. Requests
+    for methods that were never captured get no answer. Image requests are
+    answered with the captured image data, in order.
+
+    The replay keeps its connections open once the capture has been played.
+    """
+    def __init__(self, path: str, realtime=True):
+        (_, records) = read_capture(path)
+        self.realtime = realtime
+        self.started = None
+        self.streams = {}
+        self.received = defaultdict(list)
+        for record in records:
+            if record.received:
+                self.received[record.port].append(record)
+        logging.info('Replaying %d ASIAIR messages from %s', len(records), path)
+
+    async def open_connection(self, host: str, port: int):
+        if self.started is None:
+            self.started = time.monotonic()
+        # Reconnects carry on from where the last connection got to.
+        stream = self.streams.get(port)
+        if stream is None:
+            if port == IMAGE_PORT:
+                stream = ReplayImageStream(self.received[port])
+            else:
+                stream = ReplayRpcStream(self, port, self.received[port])
+            self.streams[port] = stream
+        return (stream, stream)
+
+
+class ReplayRpcStream:
+    """ Both ends of a replayed port 4400 or 4700 connection. """
+    def __init__(self, replay: Replay, port: int, records):
+        self.port = port
+        self.lines = asyncio.Queue()
+        self.responses = defaultdict(deque)
+        timed = []
+        for record in records:
+            message = parse_message(record.data)
+            if message is not None and 'Event' not in message and 'method' in message and 'id' in message:
+                self.responses[message['method']].append(message)
+            else:
+                timed.append(record)
+        self.unanswered = set()
+        self.player = asyncio.get_running_loop().create_task(self._play(replay, timed))
+
+    async def _play(self, replay: Replay, records):
+        for record in records:
+            if replay.realtime:
+                delay = replay.started + record.time - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await self.lines.put(record.data)
+        logging.info('Replay of port %d finished', self.port)
+
+    async def readline(self):
+        return await self.lines.get()
+
+    def write(self, data):
+        for line in data.splitlines():
+            request = parse_message(line)
+            if request is None:
+                continue
+            responses = self.responses.get(request.get('method'))
+            if not responses:
+                if request.get('method') not in self.unanswered:
+                    self.unanswered.add(request.get('method'))
+                    logging.warning('No %s response in the capture for port %d', request.get('method'), self.port)
+                continue
+            response = dict(responses.popleft() if len(responses) > 1 else responses[0])
+            response['id'] = request.get('id')
+            self.lines.put_nowait((json.dumps(response, ensure_ascii=False) + '\r\n').encode('iso-8859-1'))
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplayImageStream:
+    """ Both ends of a replayed port 4800 connection: the captured image bytes, in order. """
+    def __init__(self, records):
+        self.data = b''.join(record.data for record in records)
+        self.position = 0
+
+    async def read(self, n=-1):
+        end = len(self.data) if n < 0 else self.position + n
+        data = self.data[self.position:end]
+        self.position += len(data)
+        return data
+
+    async def readexactly(self, n):
+        data = await self.read(n)
+        if len(data) < n:
+            raise asyncio.IncompleteReadError(data, n)
+        return data
+
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def summarise(path: str):
+    (started, records) = read_capture(path)
+    duration = records[-1].time if records else 0
+    print('{0}: {1} records over {2:.0f}s, from {3}'.format(
+        path, len(records), duration, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started))))
+    for port in sorted({record.port for record in records}):
+        for received in (False, True):
+            selected = [record for record in records if record.port == port and record.received == received]
+            print('  port {0} {1}: {2} records, {3} bytes'.format(
+                port, 'received' if received else 'sent', len(selected), sum(len(record.data) for record in selected)))
+    events = Counter()
+    for record in records:
+        message = parse_message(record.data) if record.received and record.port != IMAGE_PORT else None
+        if message is not None and 'Event' in message:
+            events[message['Event']] += 1
+    for (event, count) in events.most_common():
+        print('  {0:<24} {1:>7} ({2:.2f}/s)'.format(event, count, count / duration if duration else 0))
+
+
+if __name__ == '__main__':
+    summarise(sys.argv[1])
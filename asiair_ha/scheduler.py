@@ -0,0 +1,100 @@
+""" A single poll scheduler for the components of every connection. """
+
+import asyncio
+from collections import namedtuple
+import heapq
+import itertools
+import logging
+import random
+import time
+
+from const import POLL_EVENTS_ONLY, POLL_JITTER_FRACTION, POLL_ONCE, POLL_STARTUP_SPREAD_SECONDS, POLL_TIMEOUT_SECONDS
+
+PollEntry = namedtuple('PollEntry', ['device', 'component', 'interval'])
+
+
+class PollScheduler:
+    """ Refreshes each component when it is due, from one heap of due times.
+
+    A component polls every component.poll_interval seconds, or its
+    connection's poll_interval if it doesn't set one. POLL_ONCE components
+    are refreshed once after registration and POLL_EVENTS_ONLY components are
+    never polled. Start times are spread out and intervals jittered so that
+    components don't all fall due together.
+
+    Refreshes run concurrently, up to the connection's poll_concurrency at a
+    time, and each is cancelled after the component's poll_timeout. A hung
+    call leaves only that component stale, and a full refresh takes about as
+    long as the slowest call rather than the sum of them.
+    """
+    def __init__(self, jitter=POLL_JITTER_FRACTION):
+        self.jitter = jitter
+        self.heap = []
+        self.sequence = itertools.count()
+        self.limits = {}
+        self.running = set()
+        self.tasks = set()
+        self.wakeup = asyncio.Event()
+
+    def add_device(self, device):
+        for component in device.components():
+            interval = component.poll_interval or device.parent.poll_interval
+            if interval == POLL_EVENTS_ONLY:
+                continue
+            spread = POLL_STARTUP_SPREAD_SECONDS if interval == POLL_ONCE else min(interval, POLL_STARTUP_SPREAD_SECONDS)
+            self._push(time.monotonic() + random.uniform(0, spread), PollEntry(device, component, interval))
+        self.wakeup.set()
+
+    def _push(self, due: float, entry: PollEntry):
+        heapq.heappush(self.heap, (due, next(self.sequence), entry))
+
+    def _next_due(self, entry: PollEntry):
+        return time.monotonic() + entry.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def run(self):
+        try:
+            while True:
+                self.wakeup.clear()
+                delay = self.heap[0][0] - time.monotonic() if self.heap else None
+                if delay is None or delay > 0:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                (_, _, entry) = heapq.heappop(self.heap)
+                if entry.interval != POLL_ONCE:
+                    self._push(self._next_due(entry), entry)
+                task = asyncio.create_task(self._refresh(entry))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        finally:
+            for task in list(self.tasks):
+                task.cancel()
+
+    def _limit(self, cnx):
+        limit = self.limits.get(id(cnx))
+        if limit is None:
+            limit = asyncio.Semaphore(cnx.poll_concurrency)
+            self.limits[id(cnx)] = limit
+        return limit
+
+    async def _refresh(self, entry: PollEntry):
+        key = (id(entry.device), entry.component.component_id)
+        if key in self.running:
+            # Still refreshing from last time; don't pile up.
+            return
+        self.running.add(key)
+        try:
+            async with self._limit(entry.device.parent):
+                logging.debug('Polling %s.%s', entry.device.name, entry.component.component_id)
+                await asyncio.wait_for(
+                    entry.component.publish(entry.device),
+                    entry.component.poll_timeout or POLL_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logging.warning('Poll of %s.%s timed out', entry.device.name, entry.component.component_id)
+        except Exception as ex:
+            logging.error('Poll of %s.%s failed: %s', entry.device.name, entry.component.component_id, ex)
+        finally:
+            self.running.discard(key)
@@ -1,4 +1,3 @@
-import asyncio
 from collections import namedtuple
 import json
 import logging
@@ -15,6 +14,8 @@ from observatory_software import Device, ObservatorySoftware
 AltAz = namedtuple('AltAz', ['alt', 'az'])
 
 class Stellarium(ObservatorySoftware):
+    poll_interval = 20
+
     def __init__(self, name, host='localhost', port='8090'):
         self.host = host
         self.port = port
@@ -30,18 +31,15 @@ class Stellarium(ObservatorySoftware):
 
 
     async def connect(self):
+        if self.session is not None:
+            await self.session.close()
         self.session = aiohttp.ClientSession('http://{0}:{1}/api/'.format(self.host, self.port))
+        # Fail here, rather than on the first poll, if Stellarium isn't running.
+        await self._get('main/status')
 
     async def discover(self):
         return self.devices
 
-    async def poll(self):
-        while True:
-            for device in self.devices.values():
-                for component in device.components():
-                    await component.publish(device)
-            await asyncio.sleep(20)
-    
     async def _get(self, path, **kwargs):
         async with self.session.get(path, params=kwargs) as response:
             print(response)
@@ -0,0 +1,29 @@
+""" Discovery topics must be ones Home Assistant reads. """
+
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from astro_mqtt import discovery_topic
+from fleet import create_connections, legacy_config
+
+# homeassistant/components/mqtt/discovery.py, applied after the discovery prefix.
+HA_TOPIC_MATCHER = re.compile(r"(?P<component>\w+)/(?:(?P<node_id>[a-zA-Z0-9_-]+)/)?(?P<object_id>[a-zA-Z0-9_-]+)/config")
+HA_DISCOVERY_PREFIX = 'homeassistant/'
+
+
+def test_discovery_topics_match_home_assistant():
+    connections = create_connections(legacy_config('asiair.local', 'localhost', 1883, None, None))
+    topics = set()
+    for (cnx_name, cnx) in connections.items():
+        for device in cnx.devices.values():
+            topic = discovery_topic(cnx_name, device)
+            assert topic.startswith(HA_DISCOVERY_PREFIX)
+            match = HA_TOPIC_MATCHER.fullmatch(topic[len(HA_DISCOVERY_PREFIX):])
+            assert match is not None, topic
+            assert match.group('component') == 'device'
+            topics.add(topic)
+    # One config per device, so none may overwrite another.
+    assert len(topics) == sum(len(cnx.devices) for cnx in connections.values())
@@ -0,0 +1,104 @@
+""" Lazily rendered Deep Zoom (DZI) tile pyramid of the latest full resolution frame. """
+
+from collections import OrderedDict
+import logging
+import math
+
+import cv2
+import numpy as np
+from astropy.visualization import AsymmetricPercentileInterval
+
+from astrolive.image import ImageManipulation
+from image_workers import run_image_job
+from const import (
+    CAMERA_SAMPLE_RESOLUTION,
+    STRETCH_AP_MINMAX_PERCENT,
+    TILE_CACHE_MAX_TILES,
+    TILE_JPEG_QUALITY,
+    TILE_SIZE,
+)
+
+DZI_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{tile_size}" Overlap="0" Format="jpg">'
+    '<Size Width="{width}" Height="{height}"/>'
+    '</Image>'
+)
+
+
+class TilePyramid:
+    """ Power-of-two levels of TILE_SIZE tiles, rendered on request.
+
+    Level max_level is the frame at full resolution and each level below it
+    halves the size, down to a single pixel at level 0. A tile is rendered
+    directly from the matching region of the raw frame, using stretch limits
+    computed once per frame so that tiles match each other. Rendered tiles are
+    kept in an LRU cache, which is emptied when a new frame arrives.
+    """
+    def __init__(self, tile_size=TILE_SIZE, max_tiles=TILE_CACHE_MAX_TILES):
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.frame = None
+        self.frame_id = 0
+        self.limits = None
+        self.max_level = 0
+        self.tiles = OrderedDict()
+
+    def set_frame(self, frame):
+        """ Replace the source frame (2D uint16). No tiles are rendered until requested. """
+        self.frame = frame
+        self.frame_id += 1
+        self.tiles.clear()
+        h, w = frame.shape
+        self.max_level = math.ceil(math.log2(max(w, h)))
+        # Estimate the stretch limits from a subsample; close enough for a preview.
+        sample = frame[::8, ::8] / ((2**CAMERA_SAMPLE_RESOLUTION) - 1)
+        self.limits = AsymmetricPercentileInterval(*STRETCH_AP_MINMAX_PERCENT).get_limits(sample)
+
+    def level_size(self, level: int):
+        scale = 2 ** (self.max_level - level)
+        h, w = self.frame.shape
+        return (math.ceil(w / scale), math.ceil(h / scale))
+
+    def descriptor(self):
+        h, w = self.frame.shape
+        return DZI_TEMPLATE.format(tile_size=self.tile_size, width=w, height=h)
+
+    def has_tile(self, level: int, col: int, row: int):
+        if self.frame is None or level < 0 or level > self.max_level:
+            return False
+        (w, h) = self.level_size(level)
+        return 0 <= col < math.ceil(w / self.tile_size) and 0 <= row < math.ceil(h / self.tile_size)
+
+    async def tile(self, level: int, col: int, row: int):
+        """ JPEG bytes for a tile of the current frame. """
+        key = (level, col, row)
+        data = self.tiles.get(key)
+        if data is not None:
+            self.tiles.move_to_end(key)
+            return data
+
+        (frame_id, limits) = (self.frame_id, self.limits)
+        region = await run_image_job(self._downsample, self.frame, level, col, row)
+        region = ImageManipulation.normalize_image(region)
+        region = ImageManipulation.compute_astropy_stretch(
+            region, minmax_percent=None, minmax_value=limits)
+        (_, data) = cv2.imencode(
+            '.jpg', (region * 255).astype(np.uint8), [cv2.IMWRITE_JPEG_QUALITY, TILE_JPEG_QUALITY])
+        data = data.tobytes()
+
+        if frame_id == self.frame_id:
+            self.tiles[key] = data
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+        logging.debug('Rendered tile %s (%d cached)', key, len(self.tiles))
+        return data
+
+    def _downsample(self, frame, level: int, col: int, row: int):
+        scale = 2 ** (math.ceil(math.log2(max(frame.shape))) - level)
+        size = self.tile_size * scale
+        region = frame[row * size:(row + 1) * size, col * size:(col + 1) * size]
+        if scale > 1:
+            h, w = region.shape
+            region = cv2.resize(region, (math.ceil(w / scale), math.ceil(h / scale)), interpolation=cv2.INTER_AREA)
+        return region.astype(np.float32)
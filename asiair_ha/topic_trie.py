@@ -0,0 +1,44 @@
+""" Exact-match lookup of MQTT topics, one topic level at a time. """
+
+
+class TopicNode:
+    __slots__ = ('children', 'value')
+
+    def __init__(self):
+        self.children = {}
+        self.value = None
+
+
+class TopicTrie:
+    """ Maps topics to values, e.g. command topics to their handlers.
+
+    A lookup walks one node per topic level, so its cost depends on the depth
+    of the topic and not on how many topics are stored.
+    """
+    def __init__(self):
+        self.root = TopicNode()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, topic: str, value):
+        node = self.root
+        for level in topic.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = TopicNode()
+                node.children[level] = child
+            node = child
+        if node.value is None:
+            self.size += 1
+        node.value = value
+
+    def lookup(self, topic: str):
+        """ The value stored for topic, or None. """
+        node = self.root
+        for level in topic.split('/'):
+            node = node.children.get(level)
+            if node is None:
+                return None
+        return node.value